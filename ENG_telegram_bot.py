@@ -1,9 +1,33 @@
 import asyncio
 import aiosqlite
-from aiogram import Bot, Dispatcher, Router
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import DeleteMessage
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+import weakref
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from queue import Empty
 from datetime import datetime, timedelta
 
 # Logging setup
@@ -13,101 +37,1269 @@ logger = logging.getLogger(__name__)
 # Configuration
 API_TOKEN = 'API_TOKEN'
 DB_NAME = 'Bot_Name'
+DB_READERS = 4  # Number of read-only connections kept open next to the single writer
+# SQLite storage profile applied to every pooled connection when it is opened.
+# The default is meant for production: WAL lets readers run while a write is in progress
+# and synchronous=NORMAL only fsyncs the WAL at checkpoints instead of on every commit.
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # ms to wait for a lock held by another connection or process
+    'cache_size': -16000,  # negative value is in KiB, ~16 MB of page cache per connection
+    'mmap_size': 268435456,  # 256 MB of the file is read through mmap
+    'temp_store': 'MEMORY',
+}
+LEDGER_BATCH_SIZE = 64  # Max money movements applied in one ledger transaction
+LEDGER_BATCH_DELAY = 0.002  # Seconds the ledger waits for more commands before committing a batch
+USER_CACHE_SIZE = 100000  # Max (balance, chips, username) records kept in memory
+USER_CACHE_TTL = 300  # Seconds a cached user record is trusted before it is re-read
+VIEW_CACHE_SIZE = 1024  # Rendered list views (per view and page) kept in memory
+SESSION_STACK_DEPTH = 8  # Menu levels kept per user; deeper taps drop the oldest level above the main menu
+SESSION_TTL = 86400  # Seconds an idle user's menu state and last bot message id are kept at least, at most twice that
+SESSION_MAX_USERS = 1000000  # Users with menu state kept in memory; reaching it drops those idle since the last rotation
+SESSION_FLUSH_INTERVAL = 1.0  # Seconds session changes are buffered before they are written to the database
+SESSION_FLUSH_SIZE = 500  # Buffered session changes that trigger a write before the interval is over
+INBOUND_RATE = 2.0  # Updates per second a user can keep sending; faster ones are dropped
+INBOUND_BURST = 8  # Updates a user can send in a quick burst before INBOUND_RATE applies
+INBOUND_CONCURRENCY = 500  # Updates handled at once by a process; more are dropped until some finish
+INBOUND_NOTICE_CACHE = 5  # Seconds Telegram clients reuse the slow-down answer of a button instead of sending the press again
+MARKETPLACE_PAGE_SIZE = 10  # Listings shown per marketplace page
+RATING_TOP_SIZE = 10  # Users shown in the rating top
+TOP_PLAYERS_SIZE = 10  # Users shown in the balance top
+HISTORY_PAGE_SIZE = 15  # Transactions shown per page of the system account history
+LISTING_PREVIEW_LENGTH = 200  # Longer descriptions are cut in listing pages to stay under Telegram's message limit
+REPORT_FETCH_SIZE = 1000  # Rows fetched per step when streaming admin reports
+TELEGRAM_MESSAGE_LIMIT = 4096  # Longer reports are sent as a text document instead of a message
+EDIT_MESSAGES = True  # Button presses edit the pressed message in place instead of sending a new one
+OUTBOUND_RATE = 30  # Bot API calls per second across all chats
+OUTBOUND_CHAT_INTERVAL = 1.0  # Seconds between calls to one chat once its burst is used up
+OUTBOUND_CHAT_BURST = 5  # Calls one chat may receive back to back
+OUTBOUND_RETRIES = 3  # Times a call is retried after a 429 before the error is raised
+ADMIN_SEND_CONCURRENCY = 8  # Admin chats notified in parallel
+OUTBOX_BATCH_SIZE = 100  # Notifications delivered per outbox round
+OUTBOX_BATCH_DELAY = 2.0  # Seconds new notifications are collected before a round; admin ones become one digest
+OUTBOX_POLL_INTERVAL = 5.0  # Seconds between outbox checks for retries that became due
+OUTBOX_RETRY_DELAY = 5.0  # Delay before the first retry of a failed notification, doubled on each attempt
+OUTBOX_MAX_ATTEMPTS = 8  # Failed attempts after which a notification is dropped
+USE_WEBHOOK = False  # Receive updates through a webhook server instead of long polling
+WEBHOOK_URL = ''  # Public URL of the webhook behind the reverse proxy; empty skips setWebhook (local testing)
+WEBHOOK_PATH = '/webhook'  # Path the server accepts updates on
+WEBHOOK_HOST = '127.0.0.1'  # Address the webhook server listens on
+WEBHOOK_PORT = 8080  # Port the webhook server listens on
+WEBHOOK_SECRET = ''  # Checked against X-Telegram-Bot-Api-Secret-Token when set
+WEBHOOK_CONCURRENCY = 100  # Updates handled at the same time in webhook mode
+WORKERS = 0  # Worker processes handling updates by user_id; 0 handles them in this process
+WORKER_SYNC_INTERVAL = 1.0  # Seconds between worker checks for writes made by other processes
+WORKER_STOP_TIMEOUT = 10.0  # Seconds a worker gets to finish its queued updates on shutdown
+PROCESSED_UPDATES_TTL = 86400  # Seconds handled update ids are kept; Telegram keeps updates for 24 hours
+CACHE_CHANGES_TTL = 3600  # Seconds records of cached data changed by workers are kept for workers that fall behind
 ADMIN_IDS = ["ADMIN_ID"]
 SYSTEM_ACCOUNT_ID = -1
 INSUFFICIENT_FUNDS_MESSAGE = "У вас недостаточно GB Coins."
+SLOW_DOWN_MESSAGE = "Too many requests, please slow down."
 INITIAL_BALANCE = 200.0
 
-# Storage for last bot message ID and user state
-last_bot_message = {}
-user_state = {}  # Stack for storing previous menus
+# Menu and input states a user can be in; sessions store a state as its index in this tuple
+STATES = ('main', 'rating_menu', 'rate_user_input', 'transfer_input', 'exchange_menu', 'marketplace',
+          'list_service_input', 'buy_input', 'admin', 'adjust_balance_input', 'adjust_chips_input',
+          'transfer_system_input', 'remove_listing_input', 'exchange_chips_input')
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+# Per-user record: menu stack as bytes of state codes and the id of the last bot message to delete
+class Session:
+    __slots__ = ('stack', 'last_message')
+
+    def __init__(self):
+        self.stack = bytes([STATE_CODES['main']])
+        self.last_message = None
+
+# Menu stacks and last bot message ids of active users, kept in two generations. A used
+# session moves to the current one; the previous one holds sessions unused since the last
+# rotation and is dropped at the next. Rotating every ttl seconds, or once max_size users
+# are stored, drops idle users after ttl to 2 * ttl seconds without a timestamp per session.
+class SessionStore:
+    def __init__(self, max_depth=SESSION_STACK_DEPTH, ttl=SESSION_TTL, max_size=SESSION_MAX_USERS):
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self.max_size = max_size
+        self.evicted = 0
+        self._current = {}
+        self._previous = {}
+        self._rotated = time.monotonic()
+
+    def _rotate(self):
+        self.evicted += len(self._previous)
+        self._previous = self._current
+        self._current = {}
+        self._rotated = time.monotonic()
+
+    def _get(self, user_id, create=False):
+        idle = time.monotonic() - self._rotated
+        if idle >= self.ttl:
+            self._rotate()
+            if idle >= 2 * self.ttl:
+                self._rotate()
+        session = self._current.get(user_id)
+        if session is None:
+            session = self._previous.pop(user_id, None)
+            if session is None:
+                if not create:
+                    return None
+                if len(self._current) + len(self._previous) >= self.max_size:
+                    self._rotate()
+                session = Session()
+            self._current[user_id] = session
+        return session
+
+    def top(self, user_id):
+        session = self._get(user_id)
+        return STATES[session.stack[-1]] if session else 'main'
+
+    # Opening the screen that is already on top does not add a level
+    def push(self, user_id, state):
+        session = self._get(user_id, create=True)
+        code = STATE_CODES[state]
+        if session.stack[-1] != code:
+            stack = session.stack
+            if len(stack) >= self.max_depth:
+                stack = stack[:1] + stack[2:]
+            session.stack = stack + bytes([code])
+
+    # Leaves the current level and returns the state below it; the main menu is never left
+    def back(self, user_id):
+        session = self._get(user_id, create=True)
+        if len(session.stack) > 1:
+            session.stack = session.stack[:-1]
+        return STATES[session.stack[-1]]
+
+    def reset(self, user_id):
+        self._get(user_id, create=True).stack = bytes([STATE_CODES['main']])
+
+    def last_message(self, user_id):
+        session = self._get(user_id)
+        return session.last_message if session else None
+
+    def set_last_message(self, user_id, message_id):
+        self._get(user_id, create=True).last_message = message_id
+
+    # (stack, last_message) of a user in memory, or None if this process has no session for them
+    def snapshot(self, user_id):
+        session = self._get(user_id)
+        return (session.stack, session.last_message) if session else None
+
+    # Puts a session loaded from storage back; states that no longer exist are skipped
+    def restore(self, user_id, states, last_message):
+        session = self._get(user_id, create=True)
+        session.stack = bytes([STATE_CODES[state] for state in states if state in STATE_CODES] or [STATE_CODES['main']])
+        session.last_message = last_message
+
+    def stats(self):
+        records = itertools.chain(self._current.values(), self._previous.values())
+        size = sum(sys.getsizeof(session) + sys.getsizeof(session.stack) for session in records)
+        return {'users': len(self._current) + len(self._previous), 'evicted': self.evicted, 'record_bytes': size}
+
+sessions = SessionStore()
 
 # Router for message handling
 router = Router()
 
+# Callback handlers keyed by action, the part of callback_data before the first ':'.
+# Every button press goes through dispatch_callback(), which finds its handler with one
+# dict lookup instead of aiogram testing one filter per handler until something matches.
+callback_handlers = {}
+
+def on_callback(*actions):
+    def register(handler):
+        for action in actions:
+            if action in callback_handlers:
+                raise ValueError(f"Callback action {action} is already registered")
+            callback_handlers[action] = CallableObject(handler)
+        return handler
+    return register
+
+@router.callback_query()
+async def dispatch_callback(callback: CallbackQuery, **data):
+    handler = callback_handlers.get((callback.data or '').split(':', 1)[0])
+    if handler is None:
+        await callback.answer()
+        return
+    await handler.call(callback, **data)
+
+# Text input handlers keyed by the state on top of the user's menu stack, dispatched by
+# dispatch_input() with one lookup however many input states there are
+input_handlers = {}
+
+def on_input(*states):
+    def register(handler):
+        for state in states:
+            if state in input_handlers:
+                raise ValueError(f"Input state {state} is already registered")
+            input_handlers[state] = CallableObject(handler)
+        return handler
+    return register
+
+# Bounded LRU cache of (balance, chips, username) keyed by user_id. Writers update it
+# through put() after commit; readers fill it through fill() with the token taken before
+# their query, so a row read before a concurrent write never overwrites the newer value.
+class UserCache:
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._writes = 0
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def read_token(self):
+        return self._writes
+
+    def fill(self, user_id, row, token):
+        if token == self._writes:
+            self._store(user_id, row)
+
+    def put(self, user_id, row):
+        self._writes += 1
+        self._store(user_id, row)
+
+    def invalidate(self, user_id):
+        self._writes += 1
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._writes += 1
+        self._entries.clear()
+
+    def _store(self, user_id, row):
+        self._entries[user_id] = (tuple(row), time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+user_cache = UserCache()
+
+# Bounded map of normalized username -> user_id, kept up to date by get_user_data() upserts
+class UsernameIndex:
+    def __init__(self, max_size=USER_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+
+    def get(self, key):
+        user_id = self._ids.get(key)
+        if user_id is not None:
+            self._ids.move_to_end(key)
+        return user_id
+
+    def put(self, key, user_id):
+        self._ids[key] = user_id
+        self._ids.move_to_end(key)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def discard(self, key, user_id):
+        if self._ids.get(key) == user_id:
+            del self._ids[key]
+
+    def clear(self):
+        self._ids.clear()
+
+username_index = UsernameIndex()
+
+# Balance leaderboard of every user except the system account, kept in memory as a list
+# sorted by (-balance, user_id). Seeded once by load_leaderboard() and then updated by
+# store_user_row() on every committed balance change, so tops and ranks need no table scan.
+class BalanceLeaderboard:
+    def __init__(self, excluded=SYSTEM_ACCOUNT_ID):
+        self.excluded = excluded
+        self._order = []
+        self._balances = {}
+        self._names = {}
+
+    def load(self, rows):
+        self._balances = {user_id: balance for user_id, balance, _ in rows if user_id != self.excluded}
+        self._names = {user_id: username for user_id, _, username in rows if user_id != self.excluded}
+        self._order = sorted((-balance, user_id) for user_id, balance in self._balances.items())
+
+    def update(self, user_id, balance, username):
+        if user_id == self.excluded:
+            return
+        self._names[user_id] = username
+        old_balance = self._balances.get(user_id)
+        if old_balance == balance:
+            return
+        if old_balance is not None:
+            del self._order[bisect_left(self._order, (-old_balance, user_id))]
+        self._balances[user_id] = balance
+        insort(self._order, (-balance, user_id))
+
+    def top(self, count):
+        return [(user_id, -key, self._names.get(user_id)) for key, user_id in self._order[:count]]
+
+    def rank(self, user_id):
+        balance = self._balances.get(user_id)
+        if balance is None:
+            return None
+        return bisect_left(self._order, (-balance, user_id)) + 1
+
+    def __len__(self):
+        return len(self._order)
+
+leaderboard = BalanceLeaderboard()
+
+# Rendered list views as (text, markup), keyed by view and page. Each entry remembers the
+# versions of the topics it was built from; writers bump a topic after commit, which makes
+# every dependent entry stale. Concurrent requests for the same key share one build.
+class ViewCache:
+    def __init__(self, max_size=VIEW_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._versions = {}
+        self._entries = OrderedDict()
+
+    def bump(self, *topics):
+        for topic in topics:
+            self._versions[topic] = self._versions.get(topic, 0) + 1
+
+    async def render(self, key, topics, build):
+        stamp = tuple(self._versions.get(topic, 0) for topic in topics)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return await asyncio.shield(entry[1])
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (stamp, future)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        try:
+            result = await build()
+        except BaseException as e:
+            if self._entries.get(key, (None, None))[1] is future:
+                del self._entries[key]
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                future.exception()
+            else:
+                future.cancel()
+            raise
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+view_cache = ViewCache()
+
+# Outbound call priorities: lower values are sent first when calls are queued
+PRIORITY_REPLY = 0
+PRIORITY_NOTIFY = 1
+PRIORITY_DELETE = 2
+
+outbound_priority = ContextVar('outbound_priority', default=PRIORITY_REPLY)
+
+# Sends made inside this block (notifications) queue behind direct replies
+@contextmanager
+def send_priority(priority):
+    token = outbound_priority.set(priority)
+    try:
+        yield
+    finally:
+        outbound_priority.reset(token)
+
+# Outbound scheduler installed as a Bot session middleware. Every call aimed at a chat waits for
+# a permit from a global token bucket (OUTBOUND_RATE per second) and from its chat's own bucket
+# (OUTBOUND_CHAT_BURST calls, then one per OUTBOUND_CHAT_INTERVAL). Queued calls are granted by
+# priority, skipping chats that are still limited, and a 429 pauses every send for retry_after.
+class OutboundLimiter(BaseRequestMiddleware):
+    def __init__(self, rate=OUTBOUND_RATE, chat_interval=OUTBOUND_CHAT_INTERVAL, chat_burst=OUTBOUND_CHAT_BURST, retries=OUTBOUND_RETRIES):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.sent = 0
+        self.throttled = 0
+        self.max_queued = 0
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_due = {}
+        self._queue = []
+        self._order = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        # getUpdates, answerCallbackQuery and the like are not per-chat sends
+        if chat_id is None:
+            return await make_request(bot, method)
+        priority = PRIORITY_DELETE if isinstance(method, DeleteMessage) else outbound_priority.get()
+        for attempt in range(self.retries + 1):
+            await self._acquire(priority, chat_id)
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.throttled += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Flood limit hit on {type(method).__name__} to {chat_id}, retrying in {e.retry_after}s")
+                continue
+            self.sent += 1
+            return result
+
+    async def _acquire(self, priority, chat_id):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._order), chat_id, future))
+        self.max_queued = max(self.max_queued, len(self._queue))
+        self._wakeup.set()
+        await future
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._grant()
+            if delay is None:
+                await self._wakeup.wait()
+            elif delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    # Grants at most one permit. Returns 0 after a grant, the seconds until one may be possible,
+    # or None when nothing is queued.
+    def _grant(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if not self._queue:
+            return None
+        if self._paused_until > now:
+            return self._paused_until - now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        skipped = []
+        wait = None
+        try:
+            while self._queue:
+                entry = heapq.heappop(self._queue)
+                _, _, chat_id, future = entry
+                if future.done():
+                    continue
+                due = max(self._chat_due.get(chat_id, now), now)
+                early = due - now - (self.chat_burst - 1) * self.chat_interval
+                if early > 0:
+                    skipped.append(entry)
+                    wait = early if wait is None else min(wait, early)
+                    continue
+                self._chat_due[chat_id] = due + self.chat_interval
+                self._tokens -= 1
+                future.set_result(None)
+                return 0
+            return wait
+        finally:
+            for entry in skipped:
+                heapq.heappush(self._queue, entry)
+            if len(self._chat_due) > USER_CACHE_SIZE:
+                self._chat_due = {chat_id: due for chat_id, due in self._chat_due.items() if due > now}
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        queued = [0, 0, 0]
+        for priority, _, _, future in self._queue:
+            if not future.done():
+                queued[priority] += 1
+        return {'queued': queued, 'max_queued': self.max_queued, 'sent': self.sent, 'throttled': self.throttled}
+
+# Sends admin notifications to every admin concurrently, at most ADMIN_SEND_CONCURRENCY chats
+# at a time. Several notifications delivered together are combined into one digest.
+# send() returns {admin_id: error} for the admins whose delivery failed.
+class AdminNotifier:
+    def __init__(self, bot, concurrency=ADMIN_SEND_CONCURRENCY):
+        self.bot = bot
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(self, batch):
+        if len(batch) == 1:
+            messages = batch
+        else:
+            messages = []
+            text = f"Admin digest, {len(batch)} events:\n"
+            for line in batch:
+                if len(text) + len(line) + 1 > TELEGRAM_MESSAGE_LIMIT:
+                    messages.append(text)
+                    text = ""
+                text += line + "\n"
+            messages.append(text)
+        with send_priority(PRIORITY_NOTIFY):
+            errors = await asyncio.gather(*(self._deliver(admin_id, messages) for admin_id in ADMIN_IDS))
+        return {admin_id: error for admin_id, error in zip(ADMIN_IDS, errors) if error is not None}
+
+    # Stops at the first failed message and returns its error
+    async def _deliver(self, admin_id, messages):
+        async with self._semaphore:
+            for message in messages:
+                try:
+                    await self.bot.send_message(admin_id, message)
+                except Exception as e:
+                    logger.error(f"Error sending notification to admin {admin_id}: {e}")
+                    return e
+        return None
+
+# Write-through for a committed users row: every in-memory view of the user is refreshed together
+def store_user_row(user_id, row):
+    user_cache.put(user_id, row)
+    leaderboard.update(user_id, row[0], row[2])
+    view_cache.bump('accounts')
+
+# Identifies this process in cache_changes, so a worker skips the changes it made itself
+CHANGE_ORIGIN = os.getpid()
+
+# Worker mode: a write that in-memory caches depend on also records the users and view topics it
+# changed in cache_changes, inside its own transaction. sync_worker() in the other workers reads
+# the new records and refreshes just those users and views. A single process records nothing.
+async def log_changes(db, user_ids=(), topics=()):
+    if not WORKERS:
+        return
+    now = time.time()
+    await db.executemany('INSERT INTO cache_changes (origin, user_id, topic, changed_at) VALUES (?, ?, ?, ?)',
+                         [(CHANGE_ORIGIN, user_id, None, now) for user_id in user_ids] +
+                         [(CHANGE_ORIGIN, None, topic, now) for topic in topics])
+
+# Database connection pool: one writer connection plus a fixed set of readers,
+# opened once in main() and shared by all handlers
+class DatabasePool:
+    def __init__(self, path, readers=DB_READERS, pragmas=DB_PRAGMAS):
+        self.path = path
+        self.readers_count = readers
+        self.pragmas = pragmas
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._connections = []
+
+    async def open(self):
+        self._writer = await self._connect()
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._connect())
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path)
+        for name, value in self.pragmas.items():
+            await conn.execute(f'PRAGMA {name} = {value}')
+        self._connections.append(conn)
+        return conn
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    # Writes are serialised on the writer connection; anything left uncommitted is rolled back
+    @asynccontextmanager
+    async def writer(self):
+        async with self._writer_lock:
+            try:
+                yield self._writer
+            finally:
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+
+# Per-user asyncio locks for handlers that change balances, so one user's money operations
+# run one at a time while other users are not blocked. Locks live in a WeakValueDictionary and
+# disappear once no handler holds or waits for them. Several users are locked in sorted order,
+# so two transfers in opposite directions cannot deadlock. The system account is never locked
+# here: every exchange touches it, and its balance is already guarded by conditional debits.
+class UserLocks:
+    def __init__(self):
+        self.contended = 0
+        self._locks = weakref.WeakValueDictionary()
+
+    def _lock(self, user_id):
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, *user_ids):
+        locks = [self._lock(user_id) for user_id in sorted(set(user_ids))]
+        acquired = []
+        try:
+            for lock in locks:
+                if lock.locked():
+                    self.contended += 1
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def stats(self):
+        return {'locks': len(self._locks), 'contended': self.contended}
+
+user_locks = UserLocks()
+
+# Raised by ledger commands when a money movement cannot be applied
+class LedgerError(Exception):
+    pass
+
+# Raised when a conditional debit finds the account short of funds
+class InsufficientFundsError(LedgerError):
+    def __init__(self, user_id):
+        super().__init__(f"insufficient funds on account {user_id}")
+        self.user_id = user_id
+
+# Id of the update a worker process is handling. Ledger commands submitted while handling it
+# record the id in processed_updates inside their own transaction, see handle_worker_update().
+current_update = ContextVar('current_update', default=None)
+
+# Records an update id as handled; False when an earlier delivery already recorded it.
+# Outside worker mode there is no update id, and the write always goes ahead.
+async def claim_update(db, update_id):
+    if update_id is None:
+        return True
+    async with db.execute('INSERT OR IGNORE INTO processed_updates (update_id, processed_at) VALUES (?, ?)',
+                          (update_id, time.time())) as cursor:
+        return cursor.rowcount > 0
+
+# Single-writer ledger: money movements are queued, applied in batches inside one
+# transaction with one commit per batch, and every caller gets its own result or error
+class Ledger:
+    def __init__(self, pool, batch_size=LEDGER_BATCH_SIZE, batch_delay=LEDGER_BATCH_DELAY):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    # Commands already queued are still applied before the task exits
+    async def stop(self):
+        if self._task:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+
+    async def submit(self, command, *args):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((command, args, future, current_update.get()))
+        return await future
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            if self.batch_delay:
+                await asyncio.sleep(self.batch_delay)
+            stopping = False
+            while len(batch) < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._apply(batch)
+            if stopping:
+                return
+
+    async def _apply(self, batch):
+        results = []
+        try:
+            async with self.pool.writer() as db:
+                await db.execute('BEGIN IMMEDIATE')
+                for command, args, future, update_id in batch:
+                    if future.cancelled():
+                        continue
+                    # Each command gets a savepoint so a failed one does not undo the rest of the batch
+                    await db.execute('SAVEPOINT ledger_command')
+                    changes = {}
+                    try:
+                        if not await claim_update(db, update_id):
+                            # A redelivered update whose money movement is already committed
+                            result = None
+                        else:
+                            result = await command(db, changes, *args)
+                    except Exception as e:
+                        await db.execute('ROLLBACK TO ledger_command')
+                        results.append((future, None, e, {}))
+                    else:
+                        results.append((future, result, None, changes))
+                    await db.execute('RELEASE ledger_command')
+                await log_changes(db, user_ids={user_id for *_, changes in results for user_id in changes})
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Error committing ledger batch of {len(batch)} commands: {e}")
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result, error, changes in results:
+            for user_id, row in changes.items():
+                store_user_row(user_id, row)
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+# Durable notification outbox. Ledger commands write notifications into the outbox table in the
+# same transaction as the money movement, and this worker delivers them after commit: rows with a
+# chat_id go to that chat, rows without one go to the admins as one digest per round. Failed
+# sends are retried with exponential backoff, and undelivered rows survive restarts. An admin
+# row that failed for some admins is replaced by one row per failed admin, retried like any chat row.
+class Outbox:
+    def __init__(self, pool, bot, notifier, batch_size=OUTBOX_BATCH_SIZE, batch_delay=OUTBOX_BATCH_DELAY):
+        self.pool = pool
+        self.bot = bot
+        self.notifier = notifier
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    # Rows left over from a previous run are delivered in the first round
+    def start(self):
+        self._stopping = False
+        self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+
+    # Rows that are already due get one last round before the task exits
+    async def stop(self):
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+    # Called after a transaction that wrote outbox rows has committed
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.batch_delay and not self._stopping:
+                await asyncio.sleep(self.batch_delay)
+            try:
+                while await self._deliver_due():
+                    pass
+            except Exception as e:
+                logger.error(f"Error delivering outbox: {e}")
+            if self._stopping:
+                return
+
+    # Delivers one batch of due rows; returns True when more rows may be waiting
+    async def _deliver_due(self):
+        now = time.time()
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT id, chat_id, text, attempts FROM outbox WHERE next_attempt <= ? ORDER BY id LIMIT ?', 
+                                (now, self.batch_size)) as cursor:
+                rows = await cursor.fetchall()
+        if not rows:
+            return False
+        done = []
+        retries = []
+        requeued = []
+        admin_rows = [row for row in rows if row[1] is None]
+        if admin_rows:
+            failed = await self.notifier.send([row[2] for row in admin_rows])
+            done.extend(row[0] for row in admin_rows)
+            # Admins that did not get the rows get them again as rows addressed to their own chat,
+            # so the retry does not send the admins that already have them a second copy
+            for admin_id, error in failed.items():
+                for outbox_id, _, text, attempts in admin_rows:
+                    next_attempt = self._next_attempt(outbox_id, admin_id, attempts, error, now)
+                    if next_attempt is not None:
+                        requeued.append((admin_id, text, attempts + 1, next_attempt))
+        chat_rows = [row for row in rows if row[1] is not None]
+        with send_priority(PRIORITY_NOTIFY):
+            results = await asyncio.gather(*(self.bot.send_message(row[1], row[2]) for row in chat_rows), return_exceptions=True)
+        for (outbox_id, chat_id, _, attempts), result in zip(chat_rows, results):
+            if not isinstance(result, Exception):
+                done.append(outbox_id)
+                continue
+            next_attempt = self._next_attempt(outbox_id, chat_id, attempts, result, now)
+            if next_attempt is None:
+                done.append(outbox_id)
+            else:
+                retries.append((next_attempt, outbox_id))
+        async with self.pool.writer() as db:
+            await db.executemany('DELETE FROM outbox WHERE id = ?', [(outbox_id,) for outbox_id in done])
+            await db.executemany('UPDATE outbox SET attempts = attempts + 1, next_attempt = ? WHERE id = ?', retries)
+            await db.executemany('INSERT INTO outbox (chat_id, text, attempts, next_attempt) VALUES (?, ?, ?, ?)', requeued)
+            await db.commit()
+        return len(rows) == self.batch_size
+
+    # Time of the next attempt after a failed send, or None when the row is dropped
+    def _next_attempt(self, outbox_id, chat_id, attempts, error, now):
+        if isinstance(error, (TelegramForbiddenError, TelegramBadRequest)):
+            # The chat blocked the bot or does not exist; retrying cannot help
+            logger.error(f"Dropping notification {outbox_id} to {chat_id}: {error}")
+            return None
+        if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(f"Dropping notification {outbox_id} to {chat_id} after {attempts + 1} attempts: {error}")
+            return None
+        logger.warning(f"Error sending notification {outbox_id} to {chat_id}, will retry: {error}")
+        return now + OUTBOX_RETRY_DELAY * 2 ** attempts
+
+# Marks the state or data of a buffered storage record that was not set since the last flush
+UNCHANGED = object()
+
+# aiogram FSM storage kept in the bot's database. Writes only update a buffer of records in
+# memory; the flush task writes all of them in one transaction every flush_interval seconds,
+# or sooner once flush_size records are waiting, so keypresses do not each cost a commit.
+# Reads check the buffer and a flush in progress before the table.
+class SqliteStorage(BaseStorage):
+    def __init__(self, pool, flush_interval=SESSION_FLUSH_INTERVAL, flush_size=SESSION_FLUSH_SIZE):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.flushes = 0
+        self.written = 0
+        self._pending = {}
+        self._flushing = {}
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    # Buffered records get one last flush before the task exits
+    async def close(self):
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing session storage: {e}")
+            if self._stopping:
+                return
+
+    # Records that fail to write go back to the buffer unless a newer value was set meanwhile
+    async def flush(self):
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, {}
+        rows = [(key, None if state is UNCHANGED else state, None if data is UNCHANGED else json.dumps(data), state is not UNCHANGED)
+                for key, (state, data) in self._flushing.items()]
+        try:
+            async with self.pool.writer() as db:
+                await db.executemany('''INSERT INTO fsm_storage (key, state, data) VALUES (?1, ?2, COALESCE(?3, '{}'))
+                                        ON CONFLICT (key) DO UPDATE SET state = IIF(?4, ?2, state), data = COALESCE(?3, data)''', rows)
+                await db.commit()
+            self.flushes += 1
+            self.written += len(rows)
+        except Exception:
+            for key, (state, data) in self._flushing.items():
+                record = self._pending.setdefault(key, [state, data])
+                if record[0] is UNCHANGED:
+                    record[0] = state
+                if record[1] is UNCHANGED:
+                    record[1] = data
+            raise
+        finally:
+            self._flushing = {}
+
+    def _buffer(self, key):
+        record = self._pending.get(key)
+        if record is None:
+            record = self._pending[key] = [UNCHANGED, UNCHANGED]
+            if len(self._pending) >= self.flush_size:
+                self._wakeup.set()
+        return record
+
+    async def _read(self, key, part):
+        for records in (self._pending, self._flushing):
+            record = records.get(key)
+            if record is not None and record[part] is not UNCHANGED:
+                return record[part]
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT state, data FROM fsm_storage WHERE key = ?', (key,)) as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            return None if part == 0 else {}
+        return row[0] if part == 0 else json.loads(row[1])
+
+    async def set_state(self, key, state=None):
+        self._buffer(self.key_builder.build(key))[0] = state.state if isinstance(state, State) else state
+
+    async def get_state(self, key):
+        return await self._read(self.key_builder.build(key), 0)
+
+    async def set_data(self, key, data):
+        self._buffer(self.key_builder.build(key))[1] = dict(data)
+
+    async def get_data(self, key):
+        return dict(await self._read(self.key_builder.build(key), 1))
+
+    def stats(self):
+        return {'pending': len(self._pending), 'flushes': self.flushes, 'written': self.written}
+
+# Loads a user's session from storage when this process has none in memory (after a restart,
+# after eviction, or when the user moved to another worker) and buffers the session in storage
+# again after the handler if it changed. The storage state is the state on top of the stack.
+class SessionMiddleware(BaseMiddleware):
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        user = event.from_user
+        if user is None:
+            return await handler(event, data)
+        key = StorageKey(bot_id=data['bot'].id, chat_id=user.id, user_id=user.id)
+        before = sessions.snapshot(user.id)
+        if before is None:
+            stored = await self.storage.get_data(key)
+            sessions.restore(user.id, stored.get('stack', ()), stored.get('last_message'))
+            before = sessions.snapshot(user.id)
+        try:
+            return await handler(event, data)
+        finally:
+            after = sessions.snapshot(user.id)
+            if after is not None and after != before:
+                stack, last_message = after
+                await self.storage.set_state(key, STATES[stack[-1]])
+                await self.storage.set_data(key, {'stack': [STATES[code] for code in stack], 'last_message': last_message})
+
+def setup_sessions(dp, storage):
+    middleware = SessionMiddleware(storage)
+    dp.message.outer_middleware(middleware)
+    dp.callback_query.outer_middleware(middleware)
+
+# Inbound throttle for messages and callback queries, registered before every other middleware.
+# Each user gets a bucket of INBOUND_BURST updates refilled at INBOUND_RATE per second (kept as
+# one due time per user, like the outbound limiter's chat buckets), and at most
+# INBOUND_CONCURRENCY updates run at once. Excess updates are dropped before any database work:
+# a button press gets a slow-down answer that the client caches, a text message is ignored.
+class InboundThrottle(BaseMiddleware):
+    def __init__(self, rate=INBOUND_RATE, burst=INBOUND_BURST, concurrency=INBOUND_CONCURRENCY):
+        self.interval = 1 / rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.passed = 0
+        self.throttled = 0
+        self.shed = 0
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._due = {}
+
+    async def __call__(self, handler, event, data):
+        user = event.from_user
+        now = time.monotonic()
+        if user is not None:
+            due = max(self._due.get(user.id, now), now)
+            if due - now > (self.burst - 1) * self.interval:
+                self.throttled += 1
+                return await self._reject(event)
+        if self._in_flight >= self.concurrency:
+            self.shed += 1
+            return await self._reject(event)
+        if user is not None:
+            self._due[user.id] = due + self.interval
+            if len(self._due) > USER_CACHE_SIZE:
+                self._due = {user_id: due for user_id, due in self._due.items() if due > now}
+        self.passed += 1
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight -= 1
+
+    async def _reject(self, event):
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer(SLOW_DOWN_MESSAGE, cache_time=INBOUND_NOTICE_CACHE)
+            except Exception as e:
+                logger.error(f"Error answering throttled callback from {event.from_user.id}: {e}")
+
+    def stats(self):
+        return {'passed': self.passed, 'throttled': self.throttled, 'shed': self.shed,
+                'in_flight': self._in_flight, 'max_in_flight': self.max_in_flight}
+
+def setup_throttling(dp):
+    throttle = InboundThrottle()
+    dp.message.outer_middleware(throttle)
+    dp.callback_query.outer_middleware(throttle)
+    return throttle
+
+# Usernames are matched case-insensitively and with or without a leading '@'
+def normalize_username(username):
+    return username.lstrip('@').lower()
+
+async def backfill_username_keys(db):
+    async with db.execute('SELECT user_id, username FROM users WHERE username IS NOT NULL') as cursor:
+        rows = await cursor.fetchall()
+    await db.executemany('UPDATE users SET username_key = ? WHERE user_id = ?', 
+                       [(normalize_username(username), user_id) for user_id, username in rows])
+
+# Schema migrations, applied in order; PRAGMA user_version stores how many have already run.
+# A step is either an SQL statement or an async function taking the connection.
+# Append new entries at the end and never edit ones that have shipped.
+MIGRATIONS = [
+    # 1: base schema
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                balance REAL DEFAULT 0,
+                chips REAL DEFAULT 0)''',
+        '''CREATE TABLE IF NOT EXISTS ratings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                rater_id INTEGER,
+                rated_id INTEGER,
+                rating INTEGER,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS daily_ratings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                points REAL,
+                date DATE)''',
+        '''CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender_id INTEGER,
+                recipient_id INTEGER,
+                amount REAL,
+                type TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS marketplace (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                seller_id INTEGER,
+                description TEXT,
+                price REAL,
+                status TEXT DEFAULT 'active')''',
+    ],
+    # 2: indexes for username lookups, rating cooldown/top, system history and active listings
+    [
+        'CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)',
+        'CREATE INDEX IF NOT EXISTS idx_ratings_pair ON ratings (rater_id, rated_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_ratings_timestamp ON ratings (timestamp, rated_id, rating)',
+        'CREATE INDEX IF NOT EXISTS idx_daily_ratings_date ON daily_ratings (date, user_id, points)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_sender ON transactions (sender_id)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_recipient ON transactions (recipient_id)',
+        'CREATE INDEX IF NOT EXISTS idx_marketplace_status ON marketplace (status, id)',
+    ],
+    # 3: normalized username column replacing the raw username index
+    [
+        'ALTER TABLE users ADD COLUMN username_key TEXT',
+        backfill_username_keys,
+        'CREATE INDEX IF NOT EXISTS idx_users_username_key ON users (username_key)',
+        'DROP INDEX IF EXISTS idx_users_username',
+    ],
+    # 4: daily_ratings becomes a per-user per-day bucket table maintained on every rating insert
+    [
+        'DELETE FROM daily_ratings',
+        '''INSERT INTO daily_ratings (user_id, points, date)
+           SELECT rated_id, SUM(rating), date(timestamp) FROM ratings GROUP BY rated_id, date(timestamp)''',
+        'DROP INDEX IF EXISTS idx_daily_ratings_date',
+        'DROP INDEX IF EXISTS idx_ratings_timestamp',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_daily_ratings_bucket ON daily_ratings (date, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_daily_ratings_top ON daily_ratings (date, points)',
+    ],
+    # 5: chip reports stream users in chips order without sorting the whole table
+    [
+        'CREATE INDEX IF NOT EXISTS idx_users_chips ON users (chips)',
+    ],
+    # 6: notification outbox written by ledger commands and drained by Outbox
+    [
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            text TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt, id)',
+    ],
+    # 7: update ids claimed by worker processes, so redelivered updates are handled once
+    [
+        '''CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id INTEGER PRIMARY KEY,
+            processed_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_processed_updates_time ON processed_updates (processed_at)',
+    ],
+    # 8: menu sessions written by SqliteStorage
+    [
+        '''CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}'
+        ) WITHOUT ROWID''',
+    ],
+    # 9: users and view topics changed by worker processes, read by the other workers' caches
+    [
+        '''CREATE TABLE IF NOT EXISTS cache_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin INTEGER NOT NULL,
+            user_id INTEGER,
+            topic TEXT,
+            changed_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_cache_changes_time ON cache_changes (changed_at)',
+    ],
+]
+
 # Database initialization
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('''CREATE TABLE IF NOT EXISTS users (
-                                user_id INTEGER PRIMARY KEY,
-                                username TEXT,
-                                balance REAL DEFAULT 0,
-                                chips REAL DEFAULT 0)''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS ratings (
-                                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                rater_id INTEGER,
-                                rated_id INTEGER,
-                                rating INTEGER,
-                                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS daily_ratings (
-                                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                user_id INTEGER,
-                                points REAL,
-                                date DATE)''')
-        async with db.execute('PRAGMA table_info(users)') as cursor:
-            columns = [row[1] for row in await cursor.fetchall()]
-            if 'chips' not in columns:
-                await db.execute('ALTER TABLE users ADD COLUMN chips REAL DEFAULT 0')
-            if 'username' not in columns:
-                await db.execute('ALTER TABLE users ADD COLUMN username TEXT')
-        await db.execute('''CREATE TABLE IF NOT EXISTS transactions (
-                                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                sender_id INTEGER,
-                                recipient_id INTEGER,
-                                amount REAL,
-                                type TEXT,
-                                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-        async with db.execute('PRAGMA table_info(transactions)') as cursor:
-            columns = [row[1] for row in await cursor.fetchall()]
-            if 'type' not in columns:
-                await db.execute('ALTER TABLE transactions ADD COLUMN type TEXT')
-        await db.execute('''CREATE TABLE IF NOT EXISTS marketplace (
-                                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                seller_id INTEGER,
-                                description TEXT,
-                                price REAL,
-                                status TEXT DEFAULT 'active')''')
-        await db.execute('INSERT OR IGNORE INTO users (user_id, balance, chips, username) VALUES (?, 0, 0, ?)', 
-                        (SYSTEM_ACCOUNT_ID, 'System'))
+async def init_db(pool):
+    async with pool.writer() as db:
+        async with db.execute('PRAGMA user_version') as cursor:
+            version = (await cursor.fetchone())[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            await db.execute('BEGIN')
+            for statement in statements:
+                if callable(statement):
+                    await statement(db)
+                else:
+                    await db.execute(statement)
+            await db.execute(f'PRAGMA user_version = {number}')
+            await db.commit()
+            logger.info(f"Applied database migration {number}")
+        await db.execute('INSERT OR IGNORE INTO users (user_id, balance, chips, username, username_key) VALUES (?, 0, 0, ?, ?)', 
+                        (SYSTEM_ACCOUNT_ID, 'System', normalize_username('System')))
         await db.commit()
 
+# Seeds the in-memory leaderboard; must run before any handler or ledger command can write.
+# Worker processes also call it from sync_worker() when they fell behind the change log.
+async def load_leaderboard(pool):
+    async with pool.reader() as db:
+        async with db.execute('SELECT user_id, balance, username FROM users') as cursor:
+            rows = await cursor.fetchall()
+    leaderboard.load(rows)
+
 # Database helper functions
-async def get_user_data(user_id, username=None):
+async def get_user_data(pool, user_id, username=None):
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute('SELECT balance, chips, username FROM users WHERE user_id = ?', (user_id,)) as cursor:
-                row = await cursor.fetchone()
-                if not row:
-                    username = username or f"User_{user_id}"
-                    await db.execute('INSERT INTO users (user_id, username, balance, chips) VALUES (?, ?, ?, 0)', 
-                                   (user_id, username, INITIAL_BALANCE))
-                    await db.commit()
-                    return (INITIAL_BALANCE, 0.0, username)
-                if username and username != row[2]:
-                    await db.execute('UPDATE users SET username = ? WHERE user_id = ?', (username, user_id))
-                    await db.commit()
-                return row
+        row = user_cache.get(user_id)
+        if row is None:
+            token = user_cache.read_token()
+            async with pool.reader() as db:
+                async with db.execute('SELECT balance, chips, username FROM users WHERE user_id = ?', (user_id,)) as cursor:
+                    row = await cursor.fetchone()
+            if row:
+                user_cache.fill(user_id, row, token)
+        if not row:
+            username = username or f"User_{user_id}"
+            async with pool.writer() as db:
+                async with db.execute('INSERT OR IGNORE INTO users (user_id, username, username_key, balance, chips) VALUES (?, ?, ?, ?, 0)', 
+                                    (user_id, username, normalize_username(username), INITIAL_BALANCE)) as cursor:
+                    inserted = cursor.rowcount > 0
+                if inserted:
+                    await log_changes(db, user_ids=(user_id,))
+                await db.commit()
+            if inserted:
+                store_user_row(user_id, (INITIAL_BALANCE, 0.0, username))
+                username_index.put(normalize_username(username), user_id)
+            return (INITIAL_BALANCE, 0.0, username)
+        if username and username != row[2]:
+            old_username = row[2]
+            async with pool.writer() as db:
+                async with db.execute('UPDATE users SET username = ?, username_key = ? WHERE user_id = ? RETURNING balance, chips, username', 
+                                    (username, normalize_username(username), user_id)) as cursor:
+                    row = await cursor.fetchone()
+                await log_changes(db, user_ids=(user_id,), topics=('usernames',))
+                await db.commit()
+            store_user_row(user_id, row)
+            view_cache.bump('usernames')
+            if old_username:
+                username_index.discard(normalize_username(old_username), user_id)
+            username_index.put(normalize_username(username), user_id)
+        return row
     except Exception as e:
         logger.error(f"Error getting user data for {user_id}: {e}")
         return (INITIAL_BALANCE, 0.0, username or f"User_{user_id}")
 
-async def get_user_id_by_username(username):
+async def get_user_id_by_username(pool, username):
     try:
-        username = username.lstrip('@')
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute('SELECT user_id FROM users WHERE username = ? OR username = ?', 
-                                (username, f"@{username}")) as cursor:
+        key = normalize_username(username)
+        user_id = username_index.get(key)
+        if user_id is not None:
+            # A cached row with a different name means the user was renamed elsewhere
+            row = user_cache.get(user_id)
+            if row is None or normalize_username(row[2] or '') == key:
+                return user_id
+            username_index.discard(key, user_id)
+        async with pool.reader() as db:
+            async with db.execute('SELECT user_id FROM users WHERE username_key = ? LIMIT 1', (key,)) as cursor:
                 row = await cursor.fetchone()
-                return row[0] if row else None
+        if not row:
+            return None
+        username_index.put(key, row[0])
+        return row[0]
     except Exception as e:
         logger.error(f"Error finding user_id by username {username}: {e}")
         return None
 
-async def update_user_data(user_id, balance=None, chips=None, increment=False):
+async def update_user_data(pool, user_id, balance=None, chips=None, increment=False):
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute('INSERT OR IGNORE INTO users (user_id, username, balance, chips) VALUES (?, ?, ?, 0)', 
-                           (user_id, f"User_{user_id}", INITIAL_BALANCE))
+        async with pool.writer() as db:
+            # A redelivered update whose change is already committed must not set the value again
+            if not await claim_update(db, current_update.get()):
+                return
+            await db.execute('INSERT OR IGNORE INTO users (user_id, username, username_key, balance, chips) VALUES (?, ?, ?, ?, 0)', 
+                           (user_id, f"User_{user_id}", normalize_username(f"User_{user_id}"), INITIAL_BALANCE))
             updates = []
             params = []
             if balance is not None:
@@ -117,35 +1309,210 @@ async def update_user_data(user_id, balance=None, chips=None, increment=False):
                 updates.append('chips = chips + ?' if increment else 'chips = ?')
                 params.append(chips)
             if updates:
-                query = f'UPDATE users SET {", ".join(updates)} WHERE user_id = ?'
+                query = f'UPDATE users SET {", ".join(updates)} WHERE user_id = ? RETURNING balance, chips, username'
                 params.append(user_id)
-                await db.execute(query, params)
+                async with db.execute(query, params) as cursor:
+                    row = await cursor.fetchone()
+            await log_changes(db, user_ids=(user_id,))
             await db.commit()
+        if updates:
+            store_user_row(user_id, row)
+        else:
+            user_cache.invalidate(user_id)
     except Exception as e:
         logger.error(f"Error updating user data for {user_id}: {e}")
 
-async def notify_admins(bot, message):
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, message)
-        except Exception as e:
-            logger.error(f"Error sending notification to admin {admin_id}: {e}")
+# One page of active listings with seller names, keyset-paginated by listing id.
+# Returns (rows, has_prev, has_next); rows are (id, seller_id, description, price, seller_username).
+async def get_marketplace_page(pool, direction='next', cursor_id=0, page_size=MARKETPLACE_PAGE_SIZE):
+    query = '''SELECT m.id, m.seller_id, m.description, m.price, u.username
+               FROM marketplace m LEFT JOIN users u ON u.user_id = m.seller_id
+               WHERE m.status = 'active' AND m.id {} ? ORDER BY m.id {} LIMIT ?'''
+    query = query.format('<', 'DESC') if direction == 'prev' else query.format('>', 'ASC')
+    async with pool.reader() as db:
+        async with db.execute(query, (cursor_id, page_size + 1)) as cursor:
+            rows = await cursor.fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == 'prev':
+        rows.reverse()
+        return rows, has_more, True
+    return rows, cursor_id > 0, has_more
+
+# One page of an account's transactions, newest first, with both party names resolved by JOIN.
+# Each side of the OR is read through its own index and limited before merging, so a page
+# costs O(page_size) however long the history is. Returns (rows, has_newer, has_older);
+# rows are (id, timestamp, amount, type, sender_id, sender_username, recipient_id, recipient_username).
+async def get_account_history(pool, account_id, direction='older', cursor_id=None, page_size=HISTORY_PAGE_SIZE):
+    query = '''WITH page AS (
+                   SELECT id FROM (SELECT id FROM transactions WHERE sender_id = :account AND id {op} :cursor
+                                   ORDER BY id {order} LIMIT :limit)
+                   UNION
+                   SELECT id FROM (SELECT id FROM transactions WHERE recipient_id = :account AND id {op} :cursor
+                                   ORDER BY id {order} LIMIT :limit))
+               SELECT t.id, t.timestamp, t.amount, t.type, t.sender_id, s.username, t.recipient_id, r.username
+               FROM page JOIN transactions t ON t.id = page.id
+               LEFT JOIN users s ON s.user_id = t.sender_id
+               LEFT JOIN users r ON r.user_id = t.recipient_id
+               ORDER BY t.id {order} LIMIT :limit'''
+    if direction == 'newer':
+        query = query.format(op='>', order='ASC')
+    else:
+        query = query.format(op='<', order='DESC')
+    params = {'account': account_id, 'cursor': cursor_id if cursor_id is not None else 2 ** 63 - 1, 'limit': page_size + 1}
+    async with pool.reader() as db:
+        async with db.execute(query, params) as cursor:
+            rows = await cursor.fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == 'newer':
+        rows.reverse()
+        return rows, has_more, True
+    return rows, cursor_id is not None, has_more
+
+# Ledger commands: run inside the ledger transaction via Ledger.submit() and never commit themselves.
+# Debits are conditional UPDATEs, so a concurrent update can never take an account below zero.
+# Every users row a command changes is recorded in `changes` for the write-through to user_cache.
+async def change_account(db, changes, query, params):
+    async with db.execute(f'{query} RETURNING user_id, balance, chips, username', params) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        changes[row[0]] = row[1:]
+    return row is not None
 
-# Delete previous messages
-async def delete_previous_messages(message: Message, bot_message: Message = None):
-    user_id = message.from_user.id
+async def debit(db, changes, user_id, amount, column='balance'):
+    if not await change_account(db, changes, f'UPDATE users SET {column} = {column} - ? WHERE user_id = ? AND {column} >= ?', 
+                                (amount, user_id, amount)):
+        raise InsufficientFundsError(user_id)
+
+async def credit(db, changes, user_id, amount, column='balance'):
+    await change_account(db, changes, f'UPDATE users SET {column} = {column} + ? WHERE user_id = ?', (amount, user_id))
+
+# Queues a notification in the current ledger transaction; chat_id None addresses all admins
+async def enqueue_notification(db, chat_id, text):
+    await db.execute('INSERT INTO outbox (chat_id, text) VALUES (?, ?)', (chat_id, text))
+
+async def ledger_transfer(db, changes, sender_id, recipient_id, amount):
+    await debit(db, changes, sender_id, amount)
+    await credit(db, changes, recipient_id, amount)
+    await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
+                   (sender_id, recipient_id, amount, 'GB'))
+
+async def ledger_exchange(db, changes, user_id, gb, chips, username):
+    if not await change_account(db, changes, 'UPDATE users SET balance = balance - ?, chips = chips + ? WHERE user_id = ? AND balance >= ?', 
+                                (gb, chips, user_id, gb)):
+        raise InsufficientFundsError(user_id)
+    await credit(db, changes, SYSTEM_ACCOUNT_ID, gb)
+    await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
+                   (user_id, SYSTEM_ACCOUNT_ID, gb, 'GB'))
+    await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
+                   (SYSTEM_ACCOUNT_ID, user_id, chips, 'chips'))
+    await enqueue_notification(db, None, f"User @{username} exchanged {gb:.2f} GBc for {chips:.2f} chips.")
+
+async def ledger_exchange_chips(db, changes, user_id, chips, gb):
+    if not await change_account(db, changes, 'UPDATE users SET chips = chips - ?, balance = balance + ? WHERE user_id = ? AND chips >= ?', 
+                                (chips, gb, user_id, chips)):
+        raise InsufficientFundsError(user_id)
+    await debit(db, changes, SYSTEM_ACCOUNT_ID, gb)
+    await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
+                   (user_id, SYSTEM_ACCOUNT_ID, chips, 'chips'))
+    await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
+                   (SYSTEM_ACCOUNT_ID, user_id, gb, 'GB'))
+
+async def ledger_buy_service(db, changes, listing_id, buyer_id, buyer_username):
+    async with db.execute("SELECT seller_id, price, description FROM marketplace WHERE id = ? AND status = 'active'", (listing_id,)) as cursor:
+        row = await cursor.fetchone()
+    if not row:
+        raise LedgerError(f"listing {listing_id} is not active")
+    seller_id, price, description = row
+    await debit(db, changes, buyer_id, price)
+    await credit(db, changes, seller_id, price)
+    await db.execute("UPDATE marketplace SET status = 'sold' WHERE id = ?", (listing_id,))
+    await log_changes(db, topics=('listings',))
+    await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
+                   (buyer_id, seller_id, price, 'GB'))
+    await enqueue_notification(db, seller_id, f"Your service '{description}' was bought by @{buyer_username} for {price:.2f} GB Coins.")
+    return row
+
+# Streams a query into a text report: rows are fetched REPORT_FETCH_SIZE at a time and written
+# to a temporary file, so memory stays bounded however many rows there are. Returns
+# (text, None, count) when the report fits in one message, otherwise (None, path, count);
+# the caller removes the file once it has been sent.
+async def build_report(pool, title, query, params, format_row):
+    handle = tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.txt', delete=False)
+    text = title
+    count = 0
+    try:
+        with handle:
+            handle.write(title)
+            async with pool.reader() as db:
+                async with db.execute(query, params) as cursor:
+                    while True:
+                        rows = await cursor.fetchmany(REPORT_FETCH_SIZE)
+                        if not rows:
+                            break
+                        lines = "".join(format_row(row) for row in rows)
+                        handle.write(lines)
+                        count += len(rows)
+                        if text is not None:
+                            text = text + lines if len(text) + len(lines) <= TELEGRAM_MESSAGE_LIMIT else None
+    except BaseException:
+        os.remove(handle.name)
+        raise
+    if text is None:
+        return None, handle.name, count
+    os.remove(handle.name)
+    return text, None, count
+
+# Delete previous messages; user_id must be passed when message is a bot message (callback.message),
+# whose from_user is the bot
+async def delete_previous_messages(message: Message, bot_message: Message = None, user_id=None):
+    if user_id is None:
+        user_id = message.from_user.id
     try:
         await message.delete()
-        if user_id in last_bot_message:
+        last_message = sessions.last_message(user_id)
+        if last_message is not None:
             try:
-                await message.bot.delete_message(message.chat.id, last_bot_message[user_id])
+                await message.bot.delete_message(message.chat.id, last_message)
             except:
                 pass
         if bot_message:
-            last_bot_message[user_id] = bot_message.message_id
+            sessions.set_last_message(user_id, bot_message.message_id)
     except Exception as e:
         logger.error(f"Error deleting messages for {user_id}: {e}")
 
+# Shows the next screen for a button press. In EDIT_MESSAGES mode the pressed message is edited
+# in place, which is one API call instead of send + two deletes; messages Telegram refuses to
+# edit (documents, messages older than 48 hours) fall back to send + delete.
+async def show_screen(callback: CallbackQuery, text, reply_markup=None):
+    user_id = callback.from_user.id
+    if EDIT_MESSAGES:
+        try:
+            await callback.message.edit_text(text, reply_markup=reply_markup)
+            sessions.set_last_message(user_id, callback.message.message_id)
+            return
+        except TelegramBadRequest as e:
+            # Pressing the button of the screen that is already shown is not an error
+            if 'message is not modified' in str(e):
+                sessions.set_last_message(user_id, callback.message.message_id)
+                return
+    bot_message = await callback.message.answer(text, reply_markup=reply_markup)
+    await delete_previous_messages(callback.message, bot_message, user_id=user_id)
+    sessions.set_last_message(user_id, bot_message.message_id)
+
+# Callback data of buttons with arguments, packed by aiogram as 'prefix:field:...'
+class ExchangeAmount(CallbackData, prefix='exchange'):
+    gb: int
+
+class MarketplacePage(CallbackData, prefix='browse'):
+    direction: str
+    cursor: int
+
+class SystemHistoryPage(CallbackData, prefix='system'):
+    direction: str
+    cursor: int
+
 # BUTTONS
 main_menu = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="Check Balance", callback_data='balance')],
@@ -164,12 +1531,12 @@ rating_menu = InlineKeyboardMarkup(inline_keyboard=[
 ])
 
 exchange_menu = InlineKeyboardMarkup(inline_keyboard=[
-    [InlineKeyboardButton(text="10 kopecks (1 GBc)", callback_data='exchange_1')],
-    [InlineKeyboardButton(text="50 kopecks (5 GBc)", callback_data='exchange_5')],
-    [InlineKeyboardButton(text="1 ruble (10 GBc)", callback_data='exchange_10')],
-    [InlineKeyboardButton(text="2 rubles (20 GBc)", callback_data='exchange_20')],
-    [InlineKeyboardButton(text="5 rubles (50 GBc)", callback_data='exchange_50')],
-    [InlineKeyboardButton(text="10 rubles (100 GBc)", callback_data='exchange_100')],
+    [InlineKeyboardButton(text="10 kopecks (1 GBc)", callback_data=ExchangeAmount(gb=1).pack())],
+    [InlineKeyboardButton(text="50 kopecks (5 GBc)", callback_data=ExchangeAmount(gb=5).pack())],
+    [InlineKeyboardButton(text="1 ruble (10 GBc)", callback_data=ExchangeAmount(gb=10).pack())],
+    [InlineKeyboardButton(text="2 rubles (20 GBc)", callback_data=ExchangeAmount(gb=20).pack())],
+    [InlineKeyboardButton(text="5 rubles (50 GBc)", callback_data=ExchangeAmount(gb=50).pack())],
+    [InlineKeyboardButton(text="10 rubles (100 GBc)", callback_data=ExchangeAmount(gb=100).pack())],
     [InlineKeyboardButton(text="Back", callback_data='back')]
 ])
 
@@ -195,27 +1562,32 @@ def get_back_button():
 
 # Handlers
 @router.message(Command('start'))
-async def start(message: Message):
+async def start(message: Message, pool: DatabasePool):
     username = message.from_user.username or message.from_user.first_name
-    await get_user_data(message.from_user.id, username)
-    user_state[message.from_user.id] = ['main']
+    await get_user_data(pool, message.from_user.id, username)
+    sessions.reset(message.from_user.id)
     bot_message = await message.answer("Welcome to GB Wallet!", reply_markup=main_menu)
     await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'rating_menu')
+# Registered after /start so the command still resets the menu from any input state
+@router.message()
+async def dispatch_input(message: Message, **data):
+    handler = input_handlers.get(sessions.top(message.from_user.id))
+    if handler is not None:
+        await handler.call(message, **data)
+
+@on_callback('rating_menu')
 async def show_rating_menu(callback: CallbackQuery):
-    user_state[callback.from_user.id].append('rating_menu')
-    bot_message = await callback.message.answer("Rating System:", reply_markup=rating_menu)
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'rating_menu')
+    await show_screen(callback, "Rating System:", reply_markup=rating_menu)
 
-@router.callback_query(lambda c: c.data == 'rate_user')
+@on_callback('rate_user')
 async def rate_user(callback: CallbackQuery):
-    user_state[callback.from_user.id].append('rate_user_input')
-    bot_message = await callback.message.answer("Enter username (with @ or without) and rating (+1 or -1) separated by space (e.g., @username +1)", reply_markup=get_back_button())
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'rate_user_input')
+    await show_screen(callback, "Enter username (with @ or without) and rating (+1 or -1) separated by space (e.g., @username +1)", reply_markup=get_back_button())
 
-@router.message(lambda message: user_state.get(message.from_user.id, ['main'])[-1] == 'rate_user_input')
-async def process_rate_user(message: Message):
+@on_input('rate_user_input')
+async def process_rate_user(message: Message, pool: DatabasePool):
     try:
         parts = message.text.split(maxsplit=1)
         if len(parts) != 2:
@@ -229,7 +1601,7 @@ async def process_rate_user(message: Message):
             await delete_previous_messages(message, bot_message)
             return
         rater_id = message.from_user.id
-        rated_id = await get_user_id_by_username(username)
+        rated_id = await get_user_id_by_username(pool, username)
         if not rated_id:
             bot_message = await message.answer(f"User {username} not found.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
@@ -238,18 +1610,26 @@ async def process_rate_user(message: Message):
             bot_message = await message.answer("You cannot rate yourself.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with pool.writer() as db:
             cutoff = datetime.now() - timedelta(days=1)
             async with db.execute('SELECT COUNT(*) FROM ratings WHERE rater_id = ? AND rated_id = ? AND timestamp > ?', 
                                 (rater_id, rated_id, cutoff)) as cursor:
                 count = (await cursor.fetchone())[0]
-                if count > 0:
-                    bot_message = await message.answer("You have already rated this user today.", reply_markup=get_back_button())
-                    await delete_previous_messages(message, bot_message)
-                    return
-            await db.execute('INSERT INTO ratings (rater_id, rated_id, rating) VALUES (?, ?, ?)', 
-                           (rater_id, rated_id, rating))
-            await db.commit()
+            if count == 0:
+                await claim_update(db, current_update.get())
+                await db.execute('INSERT INTO ratings (rater_id, rated_id, rating) VALUES (?, ?, ?)', 
+                               (rater_id, rated_id, rating))
+                # Keep today's bucket of the rated user in step with the ratings table
+                await db.execute('''INSERT INTO daily_ratings (user_id, points, date) VALUES (?, ?, date('now'))
+                                    ON CONFLICT (date, user_id) DO UPDATE SET points = points + excluded.points''', 
+                               (rated_id, rating))
+                await log_changes(db, topics=('ratings',))
+                await db.commit()
+                view_cache.bump('ratings')
+        if count > 0:
+            bot_message = await message.answer("You have already rated this user today.", reply_markup=get_back_button())
+            await delete_previous_messages(message, bot_message)
+            return
         bot_message = await message.answer(f"Rating {rating} for @{username} successfully submitted.", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
     except ValueError:
@@ -260,80 +1640,62 @@ async def process_rate_user(message: Message):
         bot_message = await message.answer(f"Error: {e}", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'rating_top')
-async def rating_top(callback: CallbackQuery):
-    try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            # Award points for the day
-            today = datetime.now().date()
-            async with db.execute('SELECT DISTINCT date FROM daily_ratings') as cursor:
-                last_date = (await cursor.fetchone())
-                if not last_date or last_date[0] != str(today):
-                    await db.execute('DELETE FROM daily_ratings WHERE date != ?', (str(today),))
-                    async with db.execute('SELECT rated_id, SUM(rating) as points FROM ratings WHERE timestamp > ? GROUP BY rated_id', 
-                                        (datetime.now() - timedelta(days=1),)) as cursor:
-                        ratings = await cursor.fetchall()
-                        for rated_id, points in ratings:
-                            await db.execute('INSERT INTO daily_ratings (user_id, points, date) VALUES (?, ?, ?)', 
-                                           (rated_id, points, today))
-                        await db.commit()
-            # Calculate total rating
-            async with db.execute('SELECT user_id, SUM(points) as total FROM daily_ratings GROUP BY user_id ORDER BY total DESC LIMIT 10') as cursor:
+@on_callback('rating_top')
+async def rating_top(callback: CallbackQuery, pool: DatabasePool):
+    async def render():
+        # Today's buckets are read straight from the (date, points) index, so this is O(RATING_TOP_SIZE)
+        async with pool.reader() as db:
+            async with db.execute('''SELECT d.user_id, d.points, u.username FROM daily_ratings d
+                                     LEFT JOIN users u ON u.user_id = d.user_id
+                                     WHERE d.date = date('now') ORDER BY d.points DESC LIMIT ?''', 
+                                (RATING_TOP_SIZE,)) as cursor:
                 rows = await cursor.fetchall()
-                top_list = []
-                for row in rows:
-                    _, _, username = await get_user_data(row[0])
-                    top_list.append(f"@{username}: {row[1]:.2f} points")
-                response = "Rating Top:\n" + "\n".join(top_list) if top_list else "List is empty"
-                bot_message = await callback.message.answer(response, reply_markup=get_back_button())
-                await delete_previous_messages(callback.message, bot_message)
+        top_list = []
+        for user_id, points, username in rows:
+            top_list.append(f"@{username or f'User_{user_id}'}: {points:.2f} points")
+        response = "Rating Top:\n" + "\n".join(top_list) if top_list else "List is empty"
+        return response, get_back_button()
+    try:
+        # The daily bucket is part of the key so the view rolls over at midnight UTC
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        response, keyboard = await view_cache.render(('rating_top', today), ('ratings', 'usernames'), render)
+        await show_screen(callback, response, reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error getting rating top: {e}")
-        bot_message = await callback.message.answer("Error getting rating top. Try again later.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Error getting rating top. Try again later.", reply_markup=get_back_button())
 
-@router.callback_query(lambda c: c.data == 'back')
+@on_callback('back')
 async def go_back(callback: CallbackQuery):
     user_id = callback.from_user.id
-    if user_id not in user_state or len(user_state[user_id]) <= 1:
-        user_state[user_id] = ['main']
-        bot_message = await callback.message.answer("Choose an action:", reply_markup=main_menu)
-        await delete_previous_messages(callback.message, bot_message)
-        return
-    user_state[user_id].pop()  # Remove last state
-    previous_state = user_state[user_id][-1]
+    previous_state = sessions.back(user_id)
     if previous_state == 'main':
-        bot_message = await callback.message.answer("Choose an action:", reply_markup=main_menu)
+        await show_screen(callback, "Choose an action:", reply_markup=main_menu)
     elif previous_state == 'marketplace':
-        bot_message = await callback.message.answer("Marketplace:", reply_markup=marketplace_menu)
+        await show_screen(callback, "Marketplace:", reply_markup=marketplace_menu)
     elif previous_state == 'admin':
-        bot_message = await callback.message.answer("Admin Panel:", reply_markup=admin_menu)
+        await show_screen(callback, "Admin Panel:", reply_markup=admin_menu)
     elif previous_state == 'rating_menu':
-        bot_message = await callback.message.answer("Rating System:", reply_markup=rating_menu)
+        await show_screen(callback, "Rating System:", reply_markup=rating_menu)
     else:
-        bot_message = await callback.message.answer("Choose an action:", reply_markup=main_menu)
-        user_state[user_id] = ['main']
-    await delete_previous_messages(callback.message, bot_message)
+        sessions.reset(user_id)
+        await show_screen(callback, "Choose an action:", reply_markup=main_menu)
 
-@router.callback_query(lambda c: c.data == 'balance')
-async def check_balance(callback: CallbackQuery):
+@on_callback('balance')
+async def check_balance(callback: CallbackQuery, pool: DatabasePool):
     try:
-        balance, chips, username = await get_user_data(callback.from_user.id, callback.from_user.username or callback.from_user.first_name)
-        bot_message = await callback.message.answer(f"Your balance (@{username}):\nGB Coins: {balance:.2f}\nChips: {chips:.2f}", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        balance, chips, username = await get_user_data(pool, callback.from_user.id, callback.from_user.username or callback.from_user.first_name)
+        await show_screen(callback, f"Your balance (@{username}):\nGB Coins: {balance:.2f}\nChips: {chips:.2f}", reply_markup=get_back_button())
     except Exception as e:
         logger.error(f"Error checking balance for {callback.from_user.id}: {e}")
-        bot_message = await callback.message.answer("Error checking balance. Try again later.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Error checking balance. Try again later.", reply_markup=get_back_button())
 
-@router.callback_query(lambda c: c.data == 'transfer')
+@on_callback('transfer')
 async def transfer(callback: CallbackQuery):
-    user_state[callback.from_user.id].append('transfer_input')
-    bot_message = await callback.message.answer("Enter recipient's username (with @ or without) and GB Coins amount separated by space (e.g., @username 10)", reply_markup=get_back_button())
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'transfer_input')
+    await show_screen(callback, "Enter recipient's username (with @ or without) and GB Coins amount separated by space (e.g., @username 10)", reply_markup=get_back_button())
 
-@router.message(lambda message: user_state.get(message.from_user.id, ['main'])[-1] == 'transfer_input')
-async def process_transfer(message: Message):
+@on_input('transfer_input')
+async def process_transfer(message: Message, pool: DatabasePool, ledger: Ledger):
     try:
         parts = message.text.split(maxsplit=1)
         if len(parts) != 2:
@@ -347,12 +1709,7 @@ async def process_transfer(message: Message):
             await delete_previous_messages(message, bot_message)
             return
         sender_id = message.from_user.id
-        sender_balance, _, _ = await get_user_data(sender_id, message.from_user.username or message.from_user.first_name)
-        if sender_balance < amount:
-            bot_message = await message.answer(INSUFFICIENT_FUNDS_MESSAGE, reply_markup=get_back_button())
-            await delete_previous_messages(message, bot_message)
-            return
-        recipient_id = await get_user_id_by_username(recipient_username)
+        recipient_id = await get_user_id_by_username(pool, recipient_username)
         if not recipient_id:
             bot_message = await message.answer(f"User {recipient_username} not found.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
@@ -361,12 +1718,13 @@ async def process_transfer(message: Message):
             bot_message = await message.answer("You cannot transfer to yourself.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (amount, sender_id))
-            await db.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, recipient_id))
-            await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
-                           (sender_id, recipient_id, amount, 'GB'))
-            await db.commit()
+        try:
+            async with user_locks.hold(sender_id, recipient_id):
+                await ledger.submit(ledger_transfer, sender_id, recipient_id, amount)
+        except InsufficientFundsError:
+            bot_message = await message.answer(INSUFFICIENT_FUNDS_MESSAGE, reply_markup=get_back_button())
+            await delete_previous_messages(message, bot_message)
+            return
         bot_message = await message.answer("Transfer completed successfully.", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
     except ValueError:
@@ -377,69 +1735,59 @@ async def process_transfer(message: Message):
         bot_message = await message.answer(f"Error: {e}", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'exchange_gb')
+@on_callback('exchange_gb')
 async def exchange_gb(callback: CallbackQuery):
-    user_state[callback.from_user.id].append('exchange_menu')
-    bot_message = await callback.message.answer("Select amount to exchange GBc to chips:", reply_markup=exchange_menu)
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'exchange_menu')
+    await show_screen(callback, "Select amount to exchange GBc to chips:", reply_markup=exchange_menu)
 
-@router.callback_query(lambda c: c.data.startswith('exchange_'))
-async def process_exchange(callback: CallbackQuery, bot: Bot):
+@on_callback('exchange')
+async def process_exchange(callback: CallbackQuery, ledger: Ledger, outbox: Outbox):
     try:
-        gb = float(callback.data.split('_')[1])
+        gb = float(ExchangeAmount.unpack(callback.data).gb)
         chips = gb / 10  # 1 GBc = 0.1 ruble
         user_id = callback.from_user.id
-        user_balance, _, username = await get_user_data(user_id, callback.from_user.username or callback.from_user.first_name)
-        if user_balance < gb:
-            bot_message = await callback.message.answer(INSUFFICIENT_FUNDS_MESSAGE, reply_markup=get_back_button())
-            await delete_previous_messages(callback.message, bot_message)
-            return
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute('UPDATE users SET balance = balance - ?, chips = chips + ? WHERE user_id = ?', 
-                           (gb, chips, user_id))
-            await db.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (gb, SYSTEM_ACCOUNT_ID))
-            await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
-                           (user_id, SYSTEM_ACCOUNT_ID, gb, 'GB'))
-            await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
-                           (SYSTEM_ACCOUNT_ID, user_id, chips, 'chips'))
-            await db.commit()
-        bot_message = await callback.message.answer(f"Exchanged {gb:.2f} GBc for {chips:.2f} chips (1 GBc = 0.1 ruble).", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
-        await notify_admins(bot, f"User @{username} exchanged {gb:.2f} GBc for {chips:.2f} chips.")
+        username = callback.from_user.username or callback.from_user.first_name
+        try:
+            async with user_locks.hold(user_id):
+                await ledger.submit(ledger_exchange, user_id, gb, chips, username)
+            outbox.wake()
+        except InsufficientFundsError:
+            await show_screen(callback, INSUFFICIENT_FUNDS_MESSAGE, reply_markup=get_back_button())
+            return
+        await show_screen(callback, f"Exchanged {gb:.2f} GBc for {chips:.2f} chips (1 GBc = 0.1 ruble).", reply_markup=get_back_button())
     except Exception as e:
         logger.error(f"Error exchanging GBc for {callback.from_user.id}: {e}")
-        bot_message = await callback.message.answer(f"Error: {e}", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, f"Error: {e}", reply_markup=get_back_button())
 
-@router.callback_query(lambda c: c.data == 'top')
+@on_callback('top')
 async def top_players(callback: CallbackQuery):
+    async def render():
+        rows = leaderboard.top(TOP_PLAYERS_SIZE)
+        top_list = "\n".join([f"@{username or f'User_{user_id}'}: {balance:.2f} GB Coins" for user_id, balance, username in rows])
+        return f"Top Players:\n{top_list or 'List is empty'}", get_back_button()
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute('SELECT user_id, balance, username FROM users WHERE user_id != ? ORDER BY balance DESC LIMIT 10', 
-                                (SYSTEM_ACCOUNT_ID,)) as cursor:
-                rows = await cursor.fetchall()
-                top_list = "\n".join([f"@{row[2] or f'User_{row[0]}'}: {row[1]:.2f} GB Coins" for row in rows])
-                bot_message = await callback.message.answer(f"Top Players:\n{top_list or 'List is empty'}", reply_markup=get_back_button())
-                await delete_previous_messages(callback.message, bot_message)
+        # The shared top is cached; only the caller's own place is added per request
+        response, keyboard = await view_cache.render(('top',), ('accounts',), render)
+        rank = leaderboard.rank(callback.from_user.id)
+        if rank is not None:
+            response += f"\n\nYour place: {rank} of {len(leaderboard)}"
+        await show_screen(callback, response, reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error getting top players: {e}")
-        bot_message = await callback.message.answer("Error getting top players. Try again later.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Error getting top players. Try again later.", reply_markup=get_back_button())
 
-@router.callback_query(lambda c: c.data == 'marketplace')
+@on_callback('marketplace')
 async def marketplace(callback: CallbackQuery):
-    user_state[callback.from_user.id].append('marketplace')
-    bot_message = await callback.message.answer("Marketplace:", reply_markup=marketplace_menu)
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'marketplace')
+    await show_screen(callback, "Marketplace:", reply_markup=marketplace_menu)
 
-@router.callback_query(lambda c: c.data == 'list_service')
+@on_callback('list_service')
 async def list_service(callback: CallbackQuery):
-    user_state[callback.from_user.id].append('list_service_input')
-    bot_message = await callback.message.answer("Enter service description and price separated by '|' (e.g., Code help|50)", reply_markup=get_back_button())
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'list_service_input')
+    await show_screen(callback, "Enter service description and price separated by '|' (e.g., Code help|50)", reply_markup=get_back_button())
 
-@router.message(lambda message: user_state.get(message.from_user.id, ['main'])[-1] == 'list_service_input')
-async def process_list_service(message: Message):
+@on_input('list_service_input')
+async def process_list_service(message: Message, pool: DatabasePool):
     try:
         parts = message.text.split('|', 1)
         if len(parts) != 2:
@@ -453,11 +1801,15 @@ async def process_list_service(message: Message):
             await delete_previous_messages(message, bot_message)
             return
         seller_id = message.from_user.id
-        await get_user_data(seller_id, message.from_user.username or message.from_user.first_name)
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute('INSERT INTO marketplace (seller_id, description, price) VALUES (?, ?, ?)', 
-                           (seller_id, description.strip(), price))
+        await get_user_data(pool, seller_id, message.from_user.username or message.from_user.first_name)
+        async with pool.writer() as db:
+            # A redelivered update whose listing is already committed does not list it twice
+            if await claim_update(db, current_update.get()):
+                await db.execute('INSERT INTO marketplace (seller_id, description, price) VALUES (?, ?, ?)', 
+                               (seller_id, description.strip(), price))
+                await log_changes(db, topics=('listings',))
             await db.commit()
+        view_cache.bump('listings')
         bot_message = await message.answer("Service listed on marketplace.", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
     except ValueError:
@@ -468,70 +1820,74 @@ async def process_list_service(message: Message):
         bot_message = await message.answer(f"Error: {e}", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'browse')
-async def browse_services(callback: CallbackQuery):
+# Marketplace pages: 'browse' opens the first page, MarketplacePage buttons ('browse:next:<id>' / 'browse:prev:<id>') page from a listing id
+@on_callback('browse')
+async def browse_services(callback: CallbackQuery, pool: DatabasePool):
+    async def render():
+        rows, has_prev, has_next = await get_marketplace_page(pool, direction, cursor_id)
+        if not rows and direction == 'prev':
+            rows, has_prev, has_next = await get_marketplace_page(pool)
+        if not rows:
+            return "No active services.", get_back_button()
+        response = "Available services:\n"
+        for listing_id, seller_id, description, price, seller_username in rows:
+            if len(description) > LISTING_PREVIEW_LENGTH:
+                description = description[:LISTING_PREVIEW_LENGTH] + "…"
+            response += f"ID: {listing_id} | {description} | Price: {price:.2f} GBc | Seller: @{seller_username or f'User_{seller_id}'}\n"
+        response += "\nTo purchase, click the button below and enter service ID."
+        navigation = []
+        if has_prev:
+            navigation.append(InlineKeyboardButton(text="« Prev", callback_data=MarketplacePage(direction='prev', cursor=rows[0][0]).pack()))
+        if has_next:
+            navigation.append(InlineKeyboardButton(text="Next »", callback_data=MarketplacePage(direction='next', cursor=rows[-1][0]).pack()))
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            *([navigation] if navigation else []),
+            [InlineKeyboardButton(text="Buy Service", callback_data='buy')],
+            [InlineKeyboardButton(text="Back", callback_data='back')]
+        ])
+        return response, keyboard
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute('SELECT id, seller_id, description, price FROM marketplace WHERE status = "active"') as cursor:
-                rows = await cursor.fetchall()
-                if not rows:
-                    bot_message = await callback.message.answer("No active services.", reply_markup=get_back_button())
-                    await delete_previous_messages(callback.message, bot_message)
-                    return
-                response = "Available services:\n"
-                for row in rows:
-                    _, _, seller_username = await get_user_data(row[1])
-                    response += f"ID: {row[0]} | {row[2]} | Price: {row[3]:.2f} GBc | Seller: @{seller_username}\n"
-                response += "\nTo purchase, click the button below and enter service ID."
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="Buy Service", callback_data='buy')],
-                    [InlineKeyboardButton(text="Back", callback_data='back')]
-                ])
-                bot_message = await callback.message.answer(response, reply_markup=keyboard)
-                await delete_previous_messages(callback.message, bot_message)
+        direction, cursor_id = 'next', 0
+        if callback.data != 'browse':
+            page = MarketplacePage.unpack(callback.data)
+            direction, cursor_id = page.direction, page.cursor
+        response, keyboard = await view_cache.render(('browse', direction, cursor_id), ('listings', 'usernames'), render)
+        await show_screen(callback, response, reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error browsing services: {e}")
-        bot_message = await callback.message.answer("Error browsing services. Try again later.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Error browsing services. Try again later.", reply_markup=get_back_button())
 
-@router.callback_query(lambda c: c.data == 'buy')
+@on_callback('buy')
 async def buy_service_start(callback: CallbackQuery):
-    user_state[callback.from_user.id].append('buy_input')
-    bot_message = await callback.message.answer("Enter service ID to purchase (e.g., 1)", reply_markup=get_back_button())
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'buy_input')
+    await show_screen(callback, "Enter service ID to purchase (e.g., 1)", reply_markup=get_back_button())
 
-@router.message(lambda message: user_state.get(message.from_user.id, ['main'])[-1] == 'buy_input')
-async def process_buy_service(message: Message, bot: Bot):
+@on_input('buy_input')
+async def process_buy_service(message: Message, pool: DatabasePool, ledger: Ledger, outbox: Outbox):
     try:
         listing_id = int(message.text)
         buyer_id = message.from_user.id
         buyer_username = message.from_user.username or message.from_user.first_name
-        _, _, buyer_username = await get_user_data(buyer_id, buyer_username)
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute('SELECT seller_id, price, status, description FROM marketplace WHERE id = ?', (listing_id,)) as cursor:
+        # The seller is credited too, so both are locked; a listing sold or removed in between is caught by the ledger
+        async with pool.reader() as db:
+            async with db.execute("SELECT seller_id FROM marketplace WHERE id = ? AND status = 'active'", (listing_id,)) as cursor:
                 row = await cursor.fetchone()
-                if not row or row[2] != 'active':
-                    bot_message = await message.answer("Service not found or already sold.", reply_markup=get_back_button())
-                    await delete_previous_messages(message, bot_message)
-                    return
-                seller_id, price, _, description = row
-                buyer_balance, _, _ = await get_user_data(buyer_id)
-                if buyer_balance < price:
-                    bot_message = await message.answer(INSUFFICIENT_FUNDS_MESSAGE, reply_markup=get_back_button())
-                    await delete_previous_messages(message, bot_message)
-                    return
-                await db.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (price, buyer_id))
-                await db.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (price, seller_id))
-                await db.execute('UPDATE marketplace SET status = "sold" WHERE id = ?', (listing_id,))
-                await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
-                               (buyer_id, seller_id, price, 'GB'))
-                await db.commit()
-            bot_message = await message.answer("Service purchased successfully.", reply_markup=get_back_button())
+        seller_ids = (row[0],) if row else ()
+        try:
+            async with user_locks.hold(buyer_id, *seller_ids):
+                await ledger.submit(ledger_buy_service, listing_id, buyer_id, buyer_username)
+            view_cache.bump('listings')
+            outbox.wake()
+        except InsufficientFundsError:
+            bot_message = await message.answer(INSUFFICIENT_FUNDS_MESSAGE, reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
-            try:
-                await bot.send_message(seller_id, f"Your service '{description}' was bought by @{buyer_username} for {price:.2f} GB Coins.")
-            except Exception as e:
-                logger.error(f"Error sending notification to seller {seller_id}: {e}")
+            return
+        except LedgerError:
+            bot_message = await message.answer("Service not found or already sold.", reply_markup=get_back_button())
+            await delete_previous_messages(message, bot_message)
+            return
+        bot_message = await message.answer("Service purchased successfully.", reply_markup=get_back_button())
+        await delete_previous_messages(message, bot_message)
     except ValueError:
         bot_message = await message.answer("Error: invalid ID format. Specify a number (e.g., 1).", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
@@ -540,28 +1896,24 @@ async def process_buy_service(message: Message, bot: Bot):
         bot_message = await message.answer(f"Error: {e}", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'admin')
+@on_callback('admin')
 async def admin_panel(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
-        bot_message = await callback.message.answer("Access denied.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Access denied.", reply_markup=get_back_button())
         return
-    user_state[callback.from_user.id].append('admin')
-    bot_message = await callback.message.answer("Admin Panel:", reply_markup=admin_menu)
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'admin')
+    await show_screen(callback, "Admin Panel:", reply_markup=admin_menu)
 
-@router.callback_query(lambda c: c.data == 'adjust_balance')
+@on_callback('adjust_balance')
 async def adjust_balance(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
-        bot_message = await callback.message.answer("Access denied.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Access denied.", reply_markup=get_back_button())
         return
-    user_state[callback.from_user.id].append('adjust_balance_input')
-    bot_message = await callback.message.answer("Enter username (with @ or without) and new GB Coins balance separated by space (e.g., @username 100)", reply_markup=get_back_button())
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'adjust_balance_input')
+    await show_screen(callback, "Enter username (with @ or without) and new GB Coins balance separated by space (e.g., @username 100)", reply_markup=get_back_button())
 
-@router.message(lambda message: user_state.get(message.from_user.id, ['main'])[-1] == 'adjust_balance_input')
-async def process_adjust_balance(message: Message):
+@on_input('adjust_balance_input')
+async def process_adjust_balance(message: Message, pool: DatabasePool):
     if message.from_user.id not in ADMIN_IDS:
         return
     try:
@@ -576,12 +1928,13 @@ async def process_adjust_balance(message: Message):
             bot_message = await message.answer("Value cannot be negative.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        user_id = await get_user_id_by_username(username)
+        user_id = await get_user_id_by_username(pool, username)
         if not user_id:
             bot_message = await message.answer(f"User {username} not found.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        await update_user_data(user_id, balance=value)
+        async with user_locks.hold(user_id):
+            await update_user_data(pool, user_id, balance=value)
         bot_message = await message.answer(f"GB Coins balance for @{username} successfully changed.", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
     except ValueError:
@@ -592,18 +1945,16 @@ async def process_adjust_balance(message: Message):
         bot_message = await message.answer(f"Error: {e}", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'adjust_chips')
+@on_callback('adjust_chips')
 async def adjust_chips(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
-        bot_message = await callback.message.answer("Access denied.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Access denied.", reply_markup=get_back_button())
         return
-    user_state[callback.from_user.id].append('adjust_chips_input')
-    bot_message = await callback.message.answer("Enter username (with @ or without) and new chips amount separated by space (e.g., @username 100)", reply_markup=get_back_button())
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'adjust_chips_input')
+    await show_screen(callback, "Enter username (with @ or without) and new chips amount separated by space (e.g., @username 100)", reply_markup=get_back_button())
 
-@router.message(lambda message: user_state.get(message.from_user.id, ['main'])[-1] == 'adjust_chips_input')
-async def process_adjust_chips(message: Message):
+@on_input('adjust_chips_input')
+async def process_adjust_chips(message: Message, pool: DatabasePool):
     if message.from_user.id not in ADMIN_IDS:
         return
     try:
@@ -618,12 +1969,13 @@ async def process_adjust_chips(message: Message):
             bot_message = await message.answer("Value cannot be negative.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        user_id = await get_user_id_by_username(username)
+        user_id = await get_user_id_by_username(pool, username)
         if not user_id:
             bot_message = await message.answer(f"User {username} not found.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        await update_user_data(user_id, chips=value)
+        async with user_locks.hold(user_id):
+            await update_user_data(pool, user_id, chips=value)
         bot_message = await message.answer(f"Chips for @{username} successfully changed.", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
     except ValueError:
@@ -634,18 +1986,16 @@ async def process_adjust_chips(message: Message):
         bot_message = await message.answer(f"Error: {e}", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'transfer_system')
+@on_callback('transfer_system')
 async def transfer_system(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
-        bot_message = await callback.message.answer("Access denied.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Access denied.", reply_markup=get_back_button())
         return
-    user_state[callback.from_user.id].append('transfer_system_input')
-    bot_message = await callback.message.answer("Enter recipient's username (with @ or without) and GB Coins amount separated by space (e.g., @username 100)", reply_markup=get_back_button())
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'transfer_system_input')
+    await show_screen(callback, "Enter recipient's username (with @ or without) and GB Coins amount separated by space (e.g., @username 100)", reply_markup=get_back_button())
 
-@router.message(lambda message: user_state.get(message.from_user.id, ['main'])[-1] == 'transfer_system_input')
-async def process_transfer_system(message: Message):
+@on_input('transfer_system_input')
+async def process_transfer_system(message: Message, pool: DatabasePool, ledger: Ledger):
     if message.from_user.id not in ADMIN_IDS:
         return
     try:
@@ -660,22 +2010,18 @@ async def process_transfer_system(message: Message):
             bot_message = await message.answer("Value cannot be negative.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        user_id = await get_user_id_by_username(username)
+        user_id = await get_user_id_by_username(pool, username)
         if not user_id:
             bot_message = await message.answer(f"User {username} not found.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        system_balance, _, _ = await get_user_data(SYSTEM_ACCOUNT_ID)
-        if system_balance < value:
+        try:
+            async with user_locks.hold(user_id):
+                await ledger.submit(ledger_transfer, SYSTEM_ACCOUNT_ID, user_id, value)
+        except InsufficientFundsError:
             bot_message = await message.answer(INSUFFICIENT_FUNDS_MESSAGE, reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (value, SYSTEM_ACCOUNT_ID))
-            await db.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (value, user_id))
-            await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
-                           (SYSTEM_ACCOUNT_ID, user_id, value, 'GB'))
-            await db.commit()
         bot_message = await message.answer(f"Transfer of {value:.2f} GBc from system account to @{username} completed successfully.", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
     except ValueError:
@@ -686,55 +2032,63 @@ async def process_transfer_system(message: Message):
         bot_message = await message.answer(f"Error: {e}", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'view_system')
-async def view_system(callback: CallbackQuery):
+# System account history: 'view_system' opens the newest page, SystemHistoryPage buttons ('system:older:<id>' / 'system:newer:<id>') page from a transaction id
+@on_callback('view_system', 'system')
+async def view_system(callback: CallbackQuery, pool: DatabasePool):
     if callback.from_user.id not in ADMIN_IDS:
-        bot_message = await callback.message.answer("Access denied.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Access denied.", reply_markup=get_back_button())
         return
     try:
-        balance, _, _ = await get_user_data(SYSTEM_ACCOUNT_ID)
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute('SELECT sender_id, recipient_id, amount, type, timestamp FROM transactions WHERE sender_id = ? OR recipient_id = ?', 
-                                (SYSTEM_ACCOUNT_ID, SYSTEM_ACCOUNT_ID)) as cursor:
-                rows = await cursor.fetchall()
-                history = []
-                for row in rows:
-                    sender_username = (await get_user_data(row[0]))[2] or f"User_{row[0]}"
-                    recipient_username = (await get_user_data(row[1]))[2] or f"User_{row[1]}"
-                    history.append(f"{row[4]}: @{sender_username} -> @{recipient_username}, {row[2]:.2f} {row[3]}")
-                history_text = "\n".join(history)
-                bot_message = await callback.message.answer(f"System Account:\nBalance: {balance:.2f} GB Coins\n\nTransaction History:\n{history_text or 'Empty'}", reply_markup=get_back_button())
-                await delete_previous_messages(callback.message, bot_message)
+        direction, cursor_id = 'older', None
+        if callback.data != 'view_system':
+            page = SystemHistoryPage.unpack(callback.data)
+            direction, cursor_id = page.direction, page.cursor
+        balance, _, _ = await get_user_data(pool, SYSTEM_ACCOUNT_ID)
+        rows, has_newer, has_older = await get_account_history(pool, SYSTEM_ACCOUNT_ID, direction, cursor_id)
+        if not rows and direction == 'newer':
+            rows, has_newer, has_older = await get_account_history(pool, SYSTEM_ACCOUNT_ID)
+        history = []
+        for _, timestamp, amount, currency, sender_id, sender_username, recipient_id, recipient_username in rows:
+            history.append(f"{timestamp}: @{sender_username or f'User_{sender_id}'} -> @{recipient_username or f'User_{recipient_id}'}, {amount:.2f} {currency}")
+        history_text = "\n".join(history)
+        navigation = []
+        if has_newer:
+            navigation.append(InlineKeyboardButton(text="« Newer", callback_data=SystemHistoryPage(direction='newer', cursor=rows[0][0]).pack()))
+        if has_older:
+            navigation.append(InlineKeyboardButton(text="Older »", callback_data=SystemHistoryPage(direction='older', cursor=rows[-1][0]).pack()))
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            *([navigation] if navigation else []),
+            [InlineKeyboardButton(text="Back", callback_data='back')]
+        ])
+        await show_screen(callback, f"System Account:\nBalance: {balance:.2f} GB Coins\n\nTransaction History:\n{history_text or 'Empty'}", reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error viewing system account: {e}")
-        bot_message = await callback.message.answer("Error viewing system account. Try again later.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Error viewing system account. Try again later.", reply_markup=get_back_button())
 
-@router.callback_query(lambda c: c.data == 'remove_listing')
+@on_callback('remove_listing')
 async def remove_listing(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
-        bot_message = await callback.message.answer("Access denied.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Access denied.", reply_markup=get_back_button())
         return
-    user_state[callback.from_user.id].append('remove_listing_input')
-    bot_message = await callback.message.answer("Enter service ID to remove (e.g., 1)", reply_markup=get_back_button())
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'remove_listing_input')
+    await show_screen(callback, "Enter service ID to remove (e.g., 1)", reply_markup=get_back_button())
 
-@router.message(lambda message: user_state.get(message.from_user.id, ['main'])[-1] == 'remove_listing_input')
-async def process_remove_listing(message: Message):
+@on_input('remove_listing_input')
+async def process_remove_listing(message: Message, pool: DatabasePool):
     if message.from_user.id not in ADMIN_IDS:
         return
     try:
         listing_id = int(message.text)
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with pool.writer() as db:
             async with db.execute('SELECT 1 FROM marketplace WHERE id = ?', (listing_id,)) as cursor:
                 if not await cursor.fetchone():
                     bot_message = await message.answer("Service not found.", reply_markup=get_back_button())
                     await delete_previous_messages(message, bot_message)
                     return
             await db.execute('DELETE FROM marketplace WHERE id = ?', (listing_id,))
+            await log_changes(db, topics=('listings',))
             await db.commit()
+        view_cache.bump('listings')
         bot_message = await message.answer("Service removed.", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
     except ValueError:
@@ -745,18 +2099,16 @@ async def process_remove_listing(message: Message):
         bot_message = await message.answer(f"Error: {e}", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'exchange_chips_to_gb')
+@on_callback('exchange_chips_to_gb')
 async def exchange_chips_to_gb(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
-        bot_message = await callback.message.answer("Access denied.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Access denied.", reply_markup=get_back_button())
         return
-    user_state[callback.from_user.id].append('exchange_chips_input')
-    bot_message = await callback.message.answer("Enter username (with @ or without) and amount in rubles to exchange chips to GBc (e.g., @username 11.4). 1 ruble = 10 GBc.", reply_markup=get_back_button())
-    await delete_previous_messages(callback.message, bot_message)
+    sessions.push(callback.from_user.id, 'exchange_chips_input')
+    await show_screen(callback, "Enter username (with @ or without) and amount in rubles to exchange chips to GBc (e.g., @username 11.4). 1 ruble = 10 GBc.", reply_markup=get_back_button())
 
-@router.message(lambda message: user_state.get(message.from_user.id, ['main'])[-1] == 'exchange_chips_input')
-async def process_exchange_chips_to_gb(message: Message):
+@on_input('exchange_chips_input')
+async def process_exchange_chips_to_gb(message: Message, pool: DatabasePool, ledger: Ledger):
     if message.from_user.id not in ADMIN_IDS:
         return
     try:
@@ -771,32 +2123,23 @@ async def process_exchange_chips_to_gb(message: Message):
             bot_message = await message.answer("Amount cannot be negative.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        user_id = await get_user_id_by_username(username)
+        user_id = await get_user_id_by_username(pool, username)
         if not user_id:
             bot_message = await message.answer(f"User {username} not found.", reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
         gb = amount_rub * 10  # 1 ruble = 10 GBc
         chips = amount_rub
-        _, user_chips, _ = await get_user_data(user_id)
-        if user_chips < chips:
-            bot_message = await message.answer("User doesn't have enough chips.", reply_markup=get_back_button())
-            await delete_previous_messages(message, bot_message)
-            return
-        system_balance, _, _ = await get_user_data(SYSTEM_ACCOUNT_ID)
-        if system_balance < gb:
-            bot_message = await message.answer(INSUFFICIENT_FUNDS_MESSAGE, reply_markup=get_back_button())
+        try:
+            async with user_locks.hold(user_id):
+                await ledger.submit(ledger_exchange_chips, user_id, chips, gb)
+        except InsufficientFundsError as e:
+            if e.user_id == user_id:
+                bot_message = await message.answer("User doesn't have enough chips.", reply_markup=get_back_button())
+            else:
+                bot_message = await message.answer(INSUFFICIENT_FUNDS_MESSAGE, reply_markup=get_back_button())
             await delete_previous_messages(message, bot_message)
             return
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute('UPDATE users SET chips = chips - ?, balance = balance + ? WHERE user_id = ?', 
-                           (chips, gb, user_id))
-            await db.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (gb, SYSTEM_ACCOUNT_ID))
-            await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
-                           (user_id, SYSTEM_ACCOUNT_ID, chips, 'chips'))
-            await db.execute('INSERT INTO transactions (sender_id, recipient_id, amount, type) VALUES (?, ?, ?, ?)', 
-                           (SYSTEM_ACCOUNT_ID, user_id, gb, 'GB'))
-            await db.commit()
         bot_message = await message.answer(f"Exchanged {chips:.2f} chips from user @{username} for {gb:.2f} GBc.", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
     except ValueError:
@@ -807,34 +2150,297 @@ async def process_exchange_chips_to_gb(message: Message):
         bot_message = await message.answer(f"Error: {e}", reply_markup=get_back_button())
         await delete_previous_messages(message, bot_message)
 
-@router.callback_query(lambda c: c.data == 'view_chips')
-async def view_chips(callback: CallbackQuery):
+@on_callback('view_chips')
+async def view_chips(callback: CallbackQuery, pool: DatabasePool):
     if callback.from_user.id not in ADMIN_IDS:
-        bot_message = await callback.message.answer("Access denied.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Access denied.", reply_markup=get_back_button())
         return
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            async with db.execute('SELECT username, chips FROM users WHERE user_id != ? ORDER BY chips DESC', 
-                                (SYSTEM_ACCOUNT_ID,)) as cursor:
-                rows = await cursor.fetchall()
-                response = "User Chips:\n"
-                for row in rows:
-                    response += f"@{row[0]}: {row[1]:.2f}\n"
-                bot_message = await callback.message.answer(response or "List is empty", reply_markup=get_back_button())
-                await delete_previous_messages(callback.message, bot_message)
+        response, path, count = await build_report(
+            pool, "User Chips:\n", 'SELECT username, chips FROM users WHERE user_id != ? ORDER BY chips DESC', 
+            (SYSTEM_ACCOUNT_ID,), lambda row: f"@{row[0]}: {row[1]:.2f}\n")
+        if path is None:
+            await show_screen(callback, response if count else "List is empty", reply_markup=get_back_button())
+            return
+        try:
+            bot_message = await callback.message.answer_document(FSInputFile(path, filename='user_chips.txt'), 
+                                                                 caption=f"User Chips: {count} users", reply_markup=get_back_button())
+        finally:
+            os.remove(path)
+        await delete_previous_messages(callback.message, bot_message, user_id=callback.from_user.id)
+        sessions.set_last_message(callback.from_user.id, bot_message.message_id)
     except Exception as e:
         logger.error(f"Error viewing chips: {e}")
-        bot_message = await callback.message.answer("Error viewing chips. Try again later.", reply_markup=get_back_button())
-        await delete_previous_messages(callback.message, bot_message)
+        await show_screen(callback, "Error viewing chips. Try again later.", reply_markup=get_back_button())
+
+# Webhook mode: an aiohttp server feeds updates to the dispatcher. Each request is handled
+# before it is answered, so the semaphore bounds updates in flight; Telegram is asked for at
+# most as many parallel connections. Runs until the task is cancelled.
+async def run_webhook(dp, bot):
+    semaphore = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+
+    @web.middleware
+    async def limit_concurrency(request, handler):
+        async with semaphore:
+            return await handler(request)
+
+    app = web.Application(middlewares=[limit_concurrency])
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=False, 
+                         secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None, max_connections=min(WEBHOOK_CONCURRENCY, 100), 
+                                  allowed_updates=dp.resolve_used_update_types())
+        logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# Worker mode: this process only receives updates. Each one is put on the queue of the worker
+# owning its user (user_id % WORKERS), and a worker runs one user's updates in queue order,
+# so every user's updates stay ordered while different users are handled on all cores.
+def start_workers(dp):
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for index in range(WORKERS):
+        queue = context.Queue()
+        process = context.Process(target=run_worker, args=(index, queue), daemon=True)
+        process.start()
+        workers.append((process, queue))
+
+    # Outer middleware that forwards the update instead of handling it here. Telegram counts the
+    # update as delivered once it is queued, so updates queued to a worker that dies or is
+    # terminated are lost; their ids are logged here and in stop_workers().
+    async def forward(handler, update, data):
+        user = getattr(update.event, 'from_user', None)
+        key = user.id if user else update.update_id
+        process, queue = workers[key % len(workers)]
+        if not process.is_alive():
+            logger.error(f"Worker {process.pid} is not running, dropping update {update.update_id}")
+            return
+        queue.put((key, update.model_dump(mode='json', exclude_unset=True)))
+
+    dp.update.outer_middleware(forward)
+    logger.info(f"Started {len(workers)} worker processes")
+    return workers
+
+async def stop_workers(workers):
+    loop = asyncio.get_running_loop()
+    for process, queue in workers:
+        queue.put(None)
+    for process, queue in workers:
+        await loop.run_in_executor(None, process.join, WORKER_STOP_TIMEOUT)
+        if process.is_alive():
+            logger.error(f"Worker {process.pid} did not stop in time, terminating it")
+            process.terminate()
+        dropped = []
+        try:
+            while True:
+                item = queue.get_nowait()
+                if item is not None:
+                    dropped.append(item[1]['update_id'])
+        except Empty:
+            pass
+        if dropped:
+            logger.error(f"Worker {process.pid} stopped before handling updates {dropped}")
+
+# Ctrl+C reaches the whole process group; workers leave shutdown to the intake process,
+# which stops them with a None on their queue once it stops receiving updates
+def run_worker(index, queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(worker_main(index, queue))
+
+# Worker process: its own bot session, pool and ledger, sharing the database with the others.
+# The outbox is only drained by the intake process, here it just receives rows from the ledger.
+async def worker_main(index, queue):
+    bot = Bot(token=API_TOKEN)
+    limiter = OutboundLimiter(rate=OUTBOUND_RATE / (WORKERS + 1))
+    bot.session.middleware(limiter)
+    pool = DatabasePool(DB_NAME)
+    await pool.open()
+    ledger = Ledger(pool)
+    storage = SqliteStorage(pool)
+    dp = Dispatcher(pool=pool, ledger=ledger, outbox=Outbox(pool, bot, AdminNotifier(bot)))
+    dp.include_router(router)
+    setup_throttling(dp)
+    setup_sessions(dp, storage)
+    loop = asyncio.get_running_loop()
+    pending = {}
+    handled = set()
+    sync = None
+
+    def done(key, task):
+        if pending.get(key) is task:
+            del pending[key]
+
+    try:
+        position = await change_log_position(pool)
+        await load_leaderboard(pool)
+        ledger.start()
+        storage.start()
+        sync = asyncio.create_task(sync_worker(pool, position, handled))
+        logger.info(f"Worker {index} started")
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            key, raw = item
+            task = asyncio.create_task(handle_worker_update(dp, bot, pool, raw, pending.get(key), handled))
+            pending[key] = task
+            task.add_done_callback(lambda task, key=key: done(key, task))
+        if pending:
+            await asyncio.wait(list(pending.values()))
+    finally:
+        if sync is not None:
+            sync.cancel()
+        await mark_handled(pool, handled)
+        await storage.close()
+        await ledger.stop()
+        await limiter.stop()
+        await bot.session.close()
+        await pool.close()
+
+# Handles one update after the previous update of the same user, skipping it when its id is
+# already in processed_updates. A money movement records the id in its own ledger transaction,
+# so it is applied once however often Telegram delivers the update; the other writes that must
+# not run twice (new listings, ratings, admin balance changes) claim the id the same way. Other
+# updates are marked only after they were handled, in batches by mark_handled(); an update that
+# failed or was cut off by a crash stays unmarked and is handled again if Telegram delivers it
+# again. Telegram does not redeliver updates the intake process already queued, see start_workers().
+async def handle_worker_update(dp, bot, pool, raw, previous, handled):
+    if previous is not None:
+        await asyncio.wait([previous])
+    update_id = raw['update_id']
+    try:
+        async with pool.reader() as db:
+            async with db.execute('SELECT 1 FROM processed_updates WHERE update_id = ?', (update_id,)) as cursor:
+                seen = await cursor.fetchone() is not None
+        if seen or update_id in handled:
+            logger.info(f"Skipping update {update_id}, it was already handled")
+            return
+        current_update.set(update_id)
+        await dp.feed_raw_update(bot, raw)
+        handled.add(update_id)
+    except Exception as e:
+        logger.error(f"Error handling update {update_id}: {e}")
+
+# Writes the ids of handled updates to processed_updates in one transaction. Ids stay in the
+# set until the commit, so they are still skipped while it is in progress or after it failed.
+async def mark_handled(pool, handled):
+    if not handled:
+        return
+    batch = list(handled)
+    now = time.time()
+    try:
+        async with pool.writer() as db:
+            await db.executemany('INSERT OR IGNORE INTO processed_updates (update_id, processed_at) VALUES (?, ?)',
+                                 [(update_id, now) for update_id in batch])
+            await db.commit()
+        handled.difference_update(batch)
+    except Exception as e:
+        logger.error(f"Error marking {len(batch)} updates as handled: {e}")
+
+# Id of the last cache_changes record, read before a worker loads its caches
+async def change_log_position(pool):
+    async with pool.reader() as db:
+        async with db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'cache_changes'") as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else 0
+
+# Caches in a worker only see its own writes. Every WORKER_SYNC_INTERVAL the worker reads the
+# cache_changes records other processes wrote since its last check, re-reads just those users
+# and bumps just those view topics. Writes that no cache depends on (handled update ids,
+# sessions) record nothing. A worker that fell behind pruned records reloads everything.
+# Handled update ids are written here, and old ones are pruned along with old change records.
+async def sync_worker(pool, position, handled):
+    pruned = 0.0
+    while True:
+        await asyncio.sleep(WORKER_SYNC_INTERVAL)
+        await mark_handled(pool, handled)
+        try:
+            if time.time() - pruned > PROCESSED_UPDATES_TTL / 24:
+                pruned = time.time()
+                async with pool.writer() as db:
+                    await db.execute('DELETE FROM processed_updates WHERE processed_at < ?', (pruned - PROCESSED_UPDATES_TTL,))
+                    await db.execute('DELETE FROM cache_changes WHERE changed_at < ?', (pruned - CACHE_CHANGES_TTL,))
+                    await db.commit()
+            async with pool.reader() as db:
+                async with db.execute('SELECT id, origin, user_id, topic FROM cache_changes WHERE id > ? ORDER BY id',
+                                      (position,)) as cursor:
+                    rows = await cursor.fetchall()
+            if not rows:
+                continue
+            if rows[0][0] > position + 1:
+                logger.warning("Worker cache fell behind the change log, reloading it")
+                user_cache.clear()
+                username_index.clear()
+                view_cache.bump('accounts', 'usernames', 'listings', 'ratings')
+                await load_leaderboard(pool)
+            else:
+                changes = [row for row in rows if row[1] != CHANGE_ORIGIN]
+                await refresh_users(pool, {user_id for _, _, user_id, _ in changes if user_id is not None})
+                view_cache.bump(*{topic for _, _, _, topic in changes if topic is not None})
+            position = rows[-1][0]
+        except Exception as e:
+            logger.error(f"Error syncing worker caches: {e}")
+
+# Re-reads users changed by other processes. The rows are read on the writer connection and stored
+# before it is released, so a newer write by this process cannot be overwritten by an older read.
+async def refresh_users(pool, user_ids):
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), REPORT_FETCH_SIZE):
+        chunk = user_ids[start:start + REPORT_FETCH_SIZE]
+        async with pool.writer() as db:
+            async with db.execute(f'SELECT user_id, balance, chips, username FROM users WHERE user_id IN ({", ".join("?" * len(chunk))})',
+                                  chunk) as cursor:
+                rows = await cursor.fetchall()
+            for user_id, *row in rows:
+                store_user_row(user_id, row)
 
 # Main function
 async def main():
     bot = Bot(token=API_TOKEN)
-    dp = Dispatcher()
+    limiter = OutboundLimiter(rate=OUTBOUND_RATE / (WORKERS + 1))
+    bot.session.middleware(limiter)
+    pool = DatabasePool(DB_NAME)
+    await pool.open()
+    ledger = Ledger(pool)
+    outbox = Outbox(pool, bot, AdminNotifier(bot))
+    storage = SqliteStorage(pool)
+    dp = Dispatcher(pool=pool, ledger=ledger, outbox=outbox)
     dp.include_router(router)
-    await init_db()
-    await dp.start_polling(bot)
+    throttle = setup_throttling(dp)
+    setup_sessions(dp, storage)
+    workers = []
+    try:
+        await init_db(pool)
+        await load_leaderboard(pool)
+        logger.info(f"Loaded balance leaderboard with {len(leaderboard)} users")
+        ledger.start()
+        outbox.start()
+        storage.start()
+        if WORKERS:
+            workers = start_workers(dp)
+        if USE_WEBHOOK:
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await stop_workers(workers)
+        await storage.close()
+        await ledger.stop()
+        await outbox.stop()
+        await limiter.stop()
+        logger.info(f"Outbound limiter stats: {limiter.stats()}")
+        logger.info(f"Session store stats: {sessions.stats()}, storage: {storage.stats()}")
+        logger.info(f"User lock stats: {user_locks.stats()}")
+        logger.info(f"Inbound throttle stats: {throttle.stats()}")
+        await bot.session.close()
+        await pool.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,76 @@
+# Cost of routing one button press: the bot's dispatch table (one dict lookup in
+# dispatch_callback) against one lambda filter per handler, which aiogram tests in order.
+# Dummy actions are added to the real table to show how both grow with the number of handlers.
+# Usage: python benchmarks/bench_callbacks.py
+import asyncio
+import itertools
+import logging
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ENG_telegram_bot as bot_module
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+UPDATES = 4000  # Updates timed per case
+WARMUP = 200  # Updates fed before timing starts
+HANDLER_COUNTS = (25, 100)  # Registered callback handlers per case
+
+_ids = itertools.count(1)
+
+def callback_update(data):
+    user = User(id=100, is_bot=False, first_name='bench')
+    message = Message(message_id=next(_ids), date=datetime.now(), chat=Chat(id=100, type='private'),
+                      from_user=User(id=42, is_bot=True, first_name='bot'), text='menu')
+    return Update(update_id=next(_ids), callback_query=CallbackQuery(id=str(next(_ids)), from_user=user,
+                                                                     chat_instance='bench', message=message, data=data))
+
+async def noop(callback: CallbackQuery):
+    pass
+
+# Registration before the dispatch table: one filter per handler
+def filter_router(count):
+    actions = [f'filter_{index}' for index in range(count)]
+    router = Router()
+    for action in actions:
+        router.callback_query(lambda callback, action=action: callback.data == action)(noop)
+    return router, actions
+
+# The bot's own router with dummy actions added to its table until it holds count handlers
+def table_router(count):
+    extra = [f'bench_{index}' for index in range(len(bot_module.callback_handlers), count)]
+    bot_module.on_callback(*extra)(noop)
+    return bot_module.router, [action for action in bot_module.callback_handlers if action.startswith('bench_')]
+
+async def time_router(router, data):
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot('42:TEST')
+    updates = [callback_update(data) for _ in range(UPDATES + WARMUP)]
+    for update in updates[:WARMUP]:
+        await dp.feed_update(bot, update)
+    start = time.perf_counter()
+    for update in updates[WARMUP:]:
+        await dp.feed_update(bot, update)
+    elapsed = time.perf_counter() - start
+    # The bot's router can be attached to one dispatcher at a time
+    bot_module.router._parent_router = None
+    return elapsed / UPDATES * 1e6
+
+async def main():
+    logging.disable(logging.INFO)
+    print(f"{'handlers':>8}  {'matched':>7}  {'filters, us':>11}  {'table, us':>9}")
+    for count in HANDLER_COUNTS:
+        router, dummy = table_router(count)
+        for position, label in ((0, 'first'), (-1, 'last')):
+            filters, actions = filter_router(count)
+            filtered = await time_router(filters, actions[position])
+            table = await time_router(router, dummy[position])
+            print(f"{count:>8}  {label:>7}  {filtered:>11.0f}  {table:>9.0f}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+# Cost of routing one text message: the bot's input state table (one lookup of the state on top
+# of the user's menu stack in dispatch_input) against one lambda filter per input state, which
+# aiogram tests in order. Dummy input states are added to show how both grow with their number.
+# Usage: python benchmarks/bench_input.py
+import asyncio
+import itertools
+import logging
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ENG_telegram_bot as bot_module
+from aiogram import Bot, Dispatcher, Router
+from aiogram.filters import Command
+from aiogram.types import Chat, Message, Update, User
+
+UPDATES = 3000  # Updates timed per case
+WARMUP = 200  # Updates fed before timing starts
+STATE_COUNTS = (10, 30, 100)  # Registered input states per case
+USER_ID = 100
+
+_ids = itertools.count(1)
+
+def message_update(text):
+    return Update(update_id=next(_ids), message=Message(message_id=next(_ids), date=datetime.now(),
+                                                         chat=Chat(id=USER_ID, type='private'),
+                                                         from_user=User(id=USER_ID, is_bot=False, first_name='bench'), text=text))
+
+async def noop(message: Message):
+    pass
+
+# Filter matching one input state. The state is bound in a closure, not as a default argument:
+# aiogram passes filters the keyword arguments they name, and 'state' is the FSM context.
+def in_state(expected):
+    return lambda message: bot_module.sessions.top(message.from_user.id) == expected
+
+# Registration before the state table: /start first, then one filter per input state in order
+def filter_router(states):
+    router = Router()
+    router.message(Command('start'))(noop)
+    for state in states:
+        router.message(in_state(state))(noop)
+    return router
+
+# The bot's own router with dummy input states added until it holds count of them
+def table_router(count):
+    extra = tuple(f'bench_{index}_input' for index in range(len(bot_module.input_handlers), count))
+    bot_module.STATES += extra
+    bot_module.STATE_CODES.update((state, bot_module.STATES.index(state)) for state in extra)
+    bot_module.on_input(*extra)(noop)
+    return bot_module.router, [state for state in bot_module.input_handlers if state.startswith('bench_')]
+
+async def time_router(router, state):
+    bot_module.sessions.reset(USER_ID)
+    bot_module.sessions.push(USER_ID, state)
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot('42:TEST')
+    updates = [message_update('hello') for _ in range(UPDATES + WARMUP)]
+    for update in updates[:WARMUP]:
+        await dp.feed_update(bot, update)
+    start = time.perf_counter()
+    for update in updates[WARMUP:]:
+        await dp.feed_update(bot, update)
+    elapsed = time.perf_counter() - start
+    # The bot's router can be attached to one dispatcher at a time
+    bot_module.router._parent_router = None
+    return elapsed / UPDATES * 1e6
+
+async def main():
+    logging.disable(logging.INFO)
+    print(f"{'states':>6}  {'matched':>7}  {'filters, us':>11}  {'table, us':>9}")
+    for count in STATE_COUNTS:
+        router, dummy = table_router(count)
+        for position, label in ((0, 'first'), (-1, 'last')):
+            target = dummy[position]
+            others = [state for state in bot_module.input_handlers if state != target]
+            order = [target] + others if label == 'first' else others + [target]
+            filtered = await time_router(filter_router(order), target)
+            table = await time_router(router, target)
+            print(f"{count:>6}  {label:>7}  {filtered:>11.0f}  {table:>9.0f}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
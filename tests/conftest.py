@@ -0,0 +1,17 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# A fresh copy of a bot module per test, so its caches, sessions and router start empty
+@pytest.fixture(params=['ENG', 'RU'])
+def bot_module(request, tmp_path):
+    name = f'{request.param}_telegram_bot'
+    spec = importlib.util.spec_from_file_location(f'{name}_{request.node.name}', ROOT / f'{name}.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.DB_NAME = str(tmp_path / 'bot.db')
+    module.ADMIN_IDS = [1]
+    return module
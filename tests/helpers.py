@@ -0,0 +1,48 @@
+import datetime
+import itertools
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendDocument, SendMessage
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+_ids = itertools.count(1000)
+
+# Bot API session that records every call instead of sending it and answers like Telegram would
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if isinstance(method, (SendMessage, SendDocument)):
+            return Message(message_id=next(_ids), date=datetime.datetime.now(),
+                           chat=Chat(id=method.chat_id, type='private'), text=getattr(method, 'text', None))
+        if isinstance(method, EditMessageText):
+            return Message(message_id=method.message_id, date=datetime.datetime.now(),
+                           chat=Chat(id=method.chat_id or 0, type='private'), text=method.text)
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    # Texts of the messages sent or edited so far
+    def texts(self):
+        return [method.text for method in self.calls if isinstance(method, (SendMessage, EditMessageText))]
+
+def user(user_id):
+    return User(id=user_id, is_bot=False, first_name=f'u{user_id}', username=f'u{user_id}')
+
+def message_update(user_id, text):
+    return Update(update_id=next(_ids), message=Message(message_id=next(_ids), date=datetime.datetime.now(),
+                                                         chat=Chat(id=user_id, type='private'),
+                                                         from_user=user(user_id), text=text))
+
+def callback_update(user_id, data):
+    message = Message(message_id=next(_ids), date=datetime.datetime.now(), chat=Chat(id=user_id, type='private'),
+                      from_user=User(id=42, is_bot=True, first_name='bot'), text='menu')
+    return Update(update_id=next(_ids), callback_query=CallbackQuery(id=str(next(_ids)), from_user=user(user_id),
+                                                                     chat_instance='test', message=message, data=data))
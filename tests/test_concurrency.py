@@ -0,0 +1,68 @@
+import asyncio
+import random
+import sqlite3
+
+from aiogram import Bot, Dispatcher
+
+from helpers import FakeSession, callback_update, message_update
+
+USERS = list(range(100, 140))
+ROUNDS = 25  # Exchanges and transfers each user sends
+
+# Feeds thousands of exchanges, transfers and purchases for 40 users at once, each user spending
+# more than their balance, and checks that no balance goes negative and that no GB is created or lost
+def test_concurrent_balance_changes(bot_module):
+    session = FakeSession()
+    result = asyncio.run(run_updates(bot_module, session))
+    db = sqlite3.connect(bot_module.DB_NAME)
+    min_balance, min_chips = db.execute('SELECT MIN(balance), MIN(chips) FROM users').fetchone()
+    total = db.execute('SELECT SUM(balance) FROM users').fetchone()[0]
+    sold = db.execute("SELECT COUNT(*) FROM marketplace WHERE status = 'sold'").fetchone()[0]
+    db.close()
+
+    assert result['updates'] > 2000
+    assert min_balance >= 0
+    assert min_chips >= 0
+    assert abs(total - bot_module.INITIAL_BALANCE * len(USERS)) < 1e-6
+    assert sold > 0
+    # Users ran out of money, so the conditional debits were actually exercised
+    assert session.texts().count(bot_module.INSUFFICIENT_FUNDS_MESSAGE) > 0
+    assert result['contended'] > 0
+    assert result['locks_left'] == 0
+
+async def run_updates(bot_module, session):
+    bot = Bot('42:TEST', session=session)
+    pool = bot_module.DatabasePool(bot_module.DB_NAME)
+    await pool.open()
+    ledger = bot_module.Ledger(pool)
+    dp = Dispatcher(pool=pool, ledger=ledger, outbox=bot_module.Outbox(pool, bot, bot_module.AdminNotifier(bot)))
+    dp.include_router(bot_module.router)
+    try:
+        await bot_module.init_db(pool)
+        await bot_module.load_leaderboard(pool)
+        ledger.start()
+        for user_id in USERS:
+            await dp.feed_update(bot, message_update(user_id, '/start'))
+        # Every fourth user lists a cheap service, bought concurrently with the other updates
+        for user_id in USERS[::4]:
+            await dp.feed_update(bot, callback_update(user_id, 'list_service'))
+            await dp.feed_update(bot, message_update(user_id, f'Service {user_id}|10'))
+        listings = len(USERS[::4])
+
+        rng = random.Random(1)
+        updates = []
+        for user_id in USERS:
+            for index in range(ROUNDS):
+                updates.append(callback_update(user_id, 'exchange:50'))
+                updates.append(callback_update(user_id, 'transfer'))
+                updates.append(message_update(user_id, f'@u{rng.choice(USERS)} {rng.choice([30, 60, 90])}'))
+                if index % 5 == 0:
+                    updates.append(callback_update(user_id, 'buy'))
+                    updates.append(message_update(user_id, str(rng.randint(1, listings))))
+        rng.shuffle(updates)
+        await asyncio.gather(*(dp.feed_update(bot, update) for update in updates))
+        stats = bot_module.user_locks.stats()
+        return {'updates': len(updates), 'contended': stats['contended'], 'locks_left': stats['locks']}
+    finally:
+        await ledger.stop()
+        await pool.close()